@@ -0,0 +1,79 @@
+
+# Copyright (C) 2011 by Oliver Ainsworth
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import json
+import time
+
+from video_index import load_json, replace_file
+
+class AuthCache(object):
+	
+	# ClientLogin tokens last two weeks, or until the password changes.
+	# A day short of that, so a cached one isn't used right up to the
+	# moment it expires.
+	lifetime = 13 * 24 * 60 * 60
+	
+	def __init__(self, path):
+		"""
+			Login sessions, as ClientLogin tokens, stored as a JSON file
+			at `path` so they can be reused by later runs rather than
+			logging in again. For each username it records:
+			
+				token		- the token
+				expires		- the time, in seconds since the epoch, the
+							token is taken to have expired
+			
+			The file is only ever readable by its owner. If it doesn't
+			exist or can't be parsed, no sessions are loaded.
+		"""
+		
+		self.path = str(path)
+		self.sessions = load_json(self.path, dict, "Login session cache")
+	
+	def token(self, username):
+		"""
+			Returns the cached token for `username`, or None if there
+			isn't one or it has expired.
+		"""
+		
+		session = self.sessions.get(username, {})
+		if session.get("expires", 0) > time.time():
+			return session.get("token")
+		
+		return None
+	
+	def store(self, username, token):
+		
+		self.sessions[username] = {
+						"token": token,
+						"expires": time.time() + self.__class__.lifetime,
+						}
+	
+	def forget(self, username):
+		
+		self.sessions.pop(username, None)
+	
+	def save(self):
+		
+		# The tokens are as good as a password until they expire, so
+		# the file is created private, rather than made so afterwards.
+		replace_file(self.path, lambda auth_file: 
+						json.dump(self.sessions, auth_file, indent=4), 0600)
@@ -0,0 +1,709 @@
+#!/usr/bin/env python
+
+# Copyright (C) 2011 by Oliver Ainsworth
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import sys
+import os
+import optparse
+import json
+import time
+import random
+import shutil
+import tempfile
+import threading
+import platform
+import contextlib
+import subprocess
+import urlparse
+import BaseHTTPServer
+import SocketServer
+from email.utils import formatdate, parsedate_tz, mktime_tz
+
+from video_index import VideoIndex, state_path
+from sqlite_video_index import SQLiteVideoIndex
+from exclusion_rule import ExclusionRule
+from feed_marks import FeedMarks
+from subbox import update_index, DEFAULT_CONFIG
+
+# Benchmarks the video index against synthetic indexes of various sizes.
+# Each result is printed as a line of JSON to stdout (or --output) so runs
+# can be compared against each other; progress goes to stderr.
+#
+#	python benchmark.py [--sizes 1000,10000,100000] [--repeat 3] ...
+
+CATEGORIES = ("Music", "Gaming", "Comedy", "Education", "Entertainment",
+				"Film", "People", "Science", "Sports", "Tech")
+
+ID_CHARS = "ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789-_"
+
+# The query shapes search() is timed with. Which words they use is
+# picked from the vocabulary, by how common they are.
+QUERY_SHAPES = (
+			("common", ("common",)),
+			("rare", ("rare",)),
+			("multi", ("common", "middling", "rare")),
+			("miss", ("missing",)),
+			("all", ()),
+			)
+
+RULES = (
+		("default", "entry.date_published < now() - days(3)"),
+		("compound", "entry.category in ('Music', 'Gaming') and "
+						"'{0}' in entry.tags or not entry.has_media"),
+		)
+
+# Run by peak_rss() in an interpreter of its own, so the peak resident
+# set sizes it prints are down to loading the index alone.
+MEMORY_SCRIPT = """
+import sys
+import resource
+from benchmark import open_index, quiet
+
+def peak():
+	return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+baseline = peak()
+with quiet():
+	videx = open_index(sys.argv[1], sys.argv[2])
+	videx.sync()
+synced = peak()
+
+for entry in videx.videos.itervalues():
+	entry.description
+
+print baseline, synced, peak()
+"""
+
+@contextlib.contextmanager
+def quiet():
+	"""
+		Silences anything printed to stdout by the code being timed.
+	"""
+	
+	stdout = sys.stdout
+	with open(os.devnull, "w") as devnull:
+		sys.stdout = devnull
+		try:
+			yield
+		finally:
+			sys.stdout = stdout
+
+def progress(message):
+	
+	sys.stderr.write(message + "\n")
+
+class Vocabulary(object):
+	
+	def __init__(self, rand, size=5000):
+		"""
+			A made-up vocabulary of `size` words. Words are picked with a
+			long tailed distribution, so a few are very common and most
+			are rare, much like real titles and descriptions.
+		"""
+		
+		syllables = ["ka", "lo", "mi", "ne", "ru", "ta", "shi", "po", "vel",
+					"dra", "qui", "zon", "ber", "fa", "gu", "hex"]
+		
+		words = set()
+		while len(words) < size:
+			words.add("".join([rand.choice(syllables) 
+								for i in xrange(rand.randint(2, 4))]))
+		
+		self.rand = rand
+		self.words = sorted(words, key=lambda word: (len(word), word))
+	
+	def word(self):
+		
+		rank = int(self.rand.paretovariate(1.1)) - 1
+		return self.words[rank % len(self.words)]
+	
+	def text(self, min_words, max_words):
+		
+		return " ".join([self.word() for i in 
+							xrange(self.rand.randint(min_words, max_words))])
+	
+	def meta(self, vid, now):
+		
+		return {
+			"id": vid,
+			"uri": "http://www.youtube.com/watch?v={0}".format(vid),
+			"title": self.text(3, 10),
+			"description": self.text(20, 200),
+			"category": self.rand.choice(CATEGORIES),
+			"tags": [self.word() for i in xrange(self.rand.randint(0, 15))],
+			"date_published": float(int(now - self.rand.uniform(0, 10 * 86400))),
+			}
+
+def video_id(rand):
+	
+	return "".join([rand.choice(ID_CHARS) for i in xrange(11)])
+
+def generate_index(directory, size, seed=0, media_ratio=0.1):
+	"""
+		Writes a synthetic index of `size` entries to `directory`, in the
+		same <id>/meta layout VideoIndex uses. `media_ratio` of them get
+		an (empty) media file. The same `seed` always generates the same
+		entries, save for their dates which are relative to now.
+	"""
+	
+	rand = random.Random(seed)
+	vocabulary = Vocabulary(rand)
+	now = time.time()
+	
+	os.makedirs(directory)
+	
+	vids = set()
+	while len(vids) < size:
+		
+		vid = video_id(rand)
+		if vid in vids:
+			continue
+		vids.add(vid)
+		
+		entry_dir = os.path.join(directory, vid)
+		os.mkdir(entry_dir)
+		with open(os.path.join(entry_dir, "meta"), "w") as meta_file:
+			json.dump(vocabulary.meta(vid, now), meta_file)
+		
+		if rand.random() < media_ratio:
+			open(os.path.join(entry_dir, "media"), "w").close()
+	
+	return vocabulary
+
+def pick_terms(vocabulary):
+	"""
+		Returns a dict of the words standing in for each kind of term
+		in QUERY_SHAPES.
+	"""
+	
+	return {
+		"common": vocabulary.words[0],
+		"middling": vocabulary.words[20],
+		"rare": vocabulary.words[500],
+		"missing": "nosuchword",
+		}
+
+def timed(func, repeat, setup=None):
+	"""
+		Calls `func` `repeat` times, calling `setup` before each, if set,
+		untimed. Returns a list of how long each call took in seconds.
+	"""
+	
+	times = []
+	for i in xrange(repeat):
+		if setup is not None:
+			setup()
+		with quiet():
+			start = time.time()
+			func()
+			times.append(time.time() - start)
+	
+	return times
+
+class Results(object):
+	
+	def __init__(self, output, common):
+		"""
+			Writes each result as a line of JSON to the file `output`.
+			Every result includes the keys and values of `common`.
+		"""
+		
+		self.output = output
+		self.common = common
+	
+	def record(self, name, size, times, **extra):
+		
+		result = dict(self.common)
+		result.update(extra)
+		result.update({
+					"benchmark": name,
+					"size": size,
+					"runs": len(times),
+					"best": min(times),
+					"mean": sum(times) / len(times),
+					})
+		
+		self.output.write(json.dumps(result, sort_keys=True) + "\n")
+		self.output.flush()
+		
+		progress("{0:<24} {1:>7} entries  best {2:.4f}s  mean {3:.4f}s".format(
+								name, size, result["best"], result["mean"]))
+	
+	def record_memory(self, name, size, peak_rss, **extra):
+		"""
+			As record(), for a peak resident set size, `peak_rss`, in
+			kilobytes rather than a list of times.
+		"""
+		
+		result = dict(self.common)
+		result.update(extra)
+		result.update({
+					"benchmark": name,
+					"size": size,
+					"peak_rss": peak_rss,
+					})
+		
+		self.output.write(json.dumps(result, sort_keys=True) + "\n")
+		self.output.flush()
+		
+		progress("{0:<24} {1:>7} entries  peak {2:.1f} MiB".format(
+												name, size, peak_rss / 1024.0))
+
+def open_index(directory, backend):
+	
+	if backend == "sqlite":
+		return SQLiteVideoIndex(directory)
+	return VideoIndex(directory)
+
+def peak_rss(directory, backend):
+	"""
+		Loads the index in `directory` in a new interpreter. Returns
+		the peak resident set size, in kilobytes, of the interpreter
+		before the index was loaded, once it was synced and once the
+		description of every entry was loaded too.
+	"""
+	
+	process = subprocess.Popen([sys.executable, "-c", MEMORY_SCRIPT, 
+								directory, backend], 
+								stdout=subprocess.PIPE,
+								cwd=os.path.dirname(os.path.abspath(__file__)))
+	output = process.communicate()[0]
+	if process.returncode != 0:
+		raise subprocess.CalledProcessError(process.returncode, "peak_rss")
+	
+	return [int(kilobytes) for kilobytes in output.split()]
+
+def bench_index(results, directory, size, vocabulary, options):
+	"""
+		Times sync(), search() and exclusion rule evaluation against the
+		synthetic index in `directory`, and measures how much memory
+		the loaded index takes.
+	"""
+	
+	with quiet():
+		open_index(directory, options.backend)
+	
+	cache_file = state_path(directory, VideoIndex.cache_name)
+	def drop_cache():
+		if os.path.exists(cache_file):
+			os.remove(cache_file)
+	
+	if options.backend == "directory":
+		results.record("sync.cold", size, timed(
+							lambda: open_index(directory, "directory").sync(),
+							options.repeat, drop_cache))
+	
+	results.record("sync.warm", size, timed(
+							lambda: open_index(directory, options.backend).sync(),
+							options.repeat))
+	
+	baseline, synced, described = peak_rss(directory, options.backend)
+	results.record_memory("memory.sync", size, synced, baseline=baseline)
+	results.record_memory("memory.descriptions", size, described, 
+							baseline=baseline)
+	
+	videx = open_index(directory, options.backend)
+	with quiet():
+		videx.sync()
+	
+	terms = pick_terms(vocabulary)
+	for shape, kinds in QUERY_SHAPES:
+		query = " ".join([terms[kind] for kind in kinds])
+		results.record("search." + shape, size, timed(
+						lambda: list(videx.search(query, 0.33, 15)), 
+						options.repeat),
+						query=query)
+	
+	for name, expression in RULES:
+		rule = ExclusionRule(expression.format(terms["common"]))
+		matched = {}
+		def filter_():
+			matched["filter"] = [entry.id for entry in 
+									rule.filter(videx.videos.itervalues())]
+		def evaluate():
+			matched["evaluate"] = [entry.id for entry in 
+									videx.videos.itervalues() 
+									if rule.evaluate(entry)]
+		
+		results.record("rule." + name, size, timed(filter_, options.repeat),
+						matched=len(matched["filter"]))
+		results.record("rule." + name + ".evaluate", size, 
+						timed(evaluate, options.repeat),
+						matched=len(matched["evaluate"]))
+		
+		# Whichever way a rule is evaluated, including as SQL by the
+		# sqlite backend's matching(), it must exclude the same videos.
+		if not (set(matched["filter"]) == set(matched["evaluate"]) == 
+					set(videx.matching(rule))):
+			raise AssertionError("rule.{0}: filter(), evaluate() and "
+									"matching() disagree".format(name))
+
+def bench_startup(results, directory, size, vocabulary, options):
+	"""
+		Times running 'subbox.py play' and 'subbox.py search' against
+		the synthetic index in `directory`, start to finish, as a user
+		would. The configuration used is the default.
+	"""
+	
+	config_dir = tempfile.mkdtemp(prefix="subbox-bench-config-")
+	env = dict(os.environ, XDG_CONFIG_HOME=config_dir)
+	subbox = os.path.join(os.path.dirname(os.path.abspath(__file__)), 
+							"subbox.py")
+	
+	vid = sorted([name for name in os.listdir(directory) 
+					if not name.startswith(".")])[0]
+	commands = (
+			("startup.play", ["play", "--cmd", "true", "--", vid]),
+			("startup.search", ["search", "-q", pick_terms(vocabulary)["rare"]]),
+			)
+	
+	try:
+		with open(os.devnull, "w") as devnull:
+			def run(args):
+				subprocess.check_call([sys.executable, subbox, args[0], 
+								"--index-dir", directory] + args[1:], 
+								stdout=devnull, env=env)
+				
+			# The first run creates the configuration file.
+			run(commands[0][1])
+			
+			for name, args in commands:
+				results.record(name, size, timed(lambda: run(args), 
+													options.repeat))
+	finally:
+		shutil.rmtree(config_dir)
+
+def bench_add(results, directory, vocabulary, options):
+	"""
+		Times adding --add-count new entries, in a batch, to an empty
+		index.
+	"""
+	
+	rand = random.Random(options.seed + 1)
+	now = time.time()
+	metas = [vocabulary.meta(video_id(rand), now) 
+				for i in xrange(options.add_count)]
+	
+	def setup():
+		if os.path.exists(directory):
+			shutil.rmtree(directory)
+		os.makedirs(directory)
+	
+	def add():
+		videx = open_index(directory, options.backend)
+		with videx.batch():
+			for meta in metas:
+				videx.add(meta)
+	
+	times = timed(add, options.repeat, setup)
+	results.record("add", options.add_count, times, 
+					per_second=options.add_count / min(times))
+
+class StubFeedServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+	
+	daemon_threads = True
+	
+	# Enough that concurrent feed requests aren't refused, and retried
+	# a second later, skewing the timings.
+	request_queue_size = 64
+	
+	def __init__(self, channels, videos, page_size, vocabulary, seed, 
+															latency=0):
+		"""
+			A local HTTP server standing in for YouTube, serving a
+			subscription feed of `channels` channels, each with an uploads
+			feed of `videos` videos, in pages of `page_size`. Requests
+			conditional on If-Modified-Since or If-None-Match are
+			honoured; nothing ever changes. Each response is delayed by
+			`latency` seconds, as if it had come from further away.
+		"""
+		
+		BaseHTTPServer.HTTPServer.__init__(self, ("127.0.0.1", 0), 
+											StubFeedHandler)
+		
+		self.uri = "http://127.0.0.1:{0}".format(self.server_address[1])
+		self.page_size = page_size
+		self.latency = latency
+		self.last_modified = int(time.time()) - 60
+		self.etag = "\"{0}\"".format(self.last_modified)
+		self.requests = 0
+		self.lock = threading.Lock()
+		
+		rand = random.Random(seed)
+		now = time.time()
+		self.channels = []
+		for channel in xrange(channels):
+			metas = [vocabulary.meta(video_id(rand), now) 
+						for i in xrange(videos)]
+			metas.sort(key=lambda meta: meta["date_published"], reverse=True)
+			self.channels.append(metas)
+	
+	def start(self):
+		
+		thread = threading.Thread(target=self.serve_forever)
+		thread.daemon = True
+		thread.start()
+	
+	def subscription_feed(self):
+		
+		entries = []
+		for channel in xrange(len(self.channels)):
+			entries.append(
+				"<entry><id>{0}/subscriptions/{1}</id>"
+				"<gd:feedLink rel='http://gdata.youtube.com/schemas/2007#"
+				"user.uploads' href='{0}/channels/{1}/uploads'/>"
+				"</entry>".format(self.uri, channel))
+		
+		return self.feed("subscriptions", "".join(entries))
+	
+	def uploads_feed(self, channel, start, count):
+		
+		metas = self.channels[channel][start - 1:start - 1 + count]
+		
+		entries = []
+		for meta in metas:
+			entries.append(
+				"<entry><id>{0}/videos/{1}</id>"
+				"<published>{2}</published>"
+				"<category scheme='http://gdata.youtube.com/schemas/2007/"
+				"categories.cat' term='{3}' label='{3}'/>"
+				"<media:group><media:title>{4}</media:title>"
+				"<media:description>{5}</media:description>"
+				"<media:keywords>{6}</media:keywords>"
+				"<media:player url='{7}'/></media:group>"
+				"</entry>".format(self.uri, meta["id"], 
+					time.strftime("%Y-%m-%dT%H:%M:%S.000Z", 
+									time.localtime(meta["date_published"])),
+					meta["category"], meta["title"], meta["description"],
+					", ".join(meta["tags"]), meta["uri"]))
+		
+		links = ""
+		if start - 1 + count < len(self.channels[channel]):
+			links = "<link rel='next' href='{0}/channels/{1}/uploads?" \
+					"start-index={2}&amp;max-results={3}'/>".format(
+										self.uri, channel, start + count, count)
+		
+		return self.feed("uploads", links + "".join(entries))
+	
+	def feed(self, name, content):
+		
+		return ("<?xml version='1.0' encoding='UTF-8'?>"
+				"<feed xmlns='http://www.w3.org/2005/Atom' "
+				"xmlns:media='http://search.yahoo.com/mrss/' "
+				"xmlns:gd='http://schemas.google.com/g/2005' "
+				"xmlns:yt='http://gdata.youtube.com/schemas/2007'>"
+				"<id>{0}/{1}</id>{2}</feed>".format(self.uri, name, content))
+
+class StubFeedHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+	
+	def do_GET(self):
+		
+		server = self.server
+		with server.lock:
+			server.requests += 1
+		
+		time.sleep(server.latency)
+		
+		url = urlparse.urlparse(self.path)
+		query = dict(urlparse.parse_qsl(url.query))
+		parts = url.path.strip("/").split("/")
+		
+		since = self.headers.getheader("If-Modified-Since")
+		if (self.headers.getheader("If-None-Match") == server.etag or since and
+				mktime_tz(parsedate_tz(since)) >= server.last_modified):
+			self.send_response(304)
+			self.end_headers()
+			return
+		
+		if parts == ["subscriptions"]:
+			body = server.subscription_feed()
+		elif len(parts) == 3 and parts[0] == "channels" and parts[2] == "uploads":
+			body = server.uploads_feed(int(parts[1]), 
+								int(query.get("start-index", 1)), 
+								int(query.get("max-results", server.page_size)))
+		else:
+			self.send_error(404)
+			return
+		
+		self.send_response(200)
+		self.send_header("Content-Type", "application/atom+xml")
+		self.send_header("Content-Length", str(len(body)))
+		self.send_header("Last-Modified", 
+							formatdate(server.last_modified, usegmt=True))
+		self.send_header("ETag", server.etag)
+		self.end_headers()
+		self.wfile.write(body)
+	
+	def log_message(self, format, *args):
+		pass
+
+def run_update(client, server, videx, marks, threads, pages, page_size):
+	"""
+		Runs 'subbox.py update' against the stub server instead of
+		YouTube, with the default exclusion rule. Returns the number of
+		videos added.
+	"""
+	
+	import gdata.youtube
+	
+	sub_feed = client._ThrottledCall(client.Get, server.uri + "/subscriptions",
+						converter=gdata.youtube.YouTubeSubscriptionFeedFromString)
+	
+	return update_index(client, videx, sub_feed, marks,
+						ExclusionRule(DEFAULT_CONFIG["rule"]), page_size, pages,
+						1, threads)
+
+def bench_update(results, directory, vocabulary, options):
+	"""
+		Times an update of an empty index from the stub server, then an
+		update of the same index when none of the feeds have changed.
+		Then updates of an empty index again, with the responses cached:
+		fresh, so no requests are made, and stale, so each is
+		revalidated.
+	"""
+	
+	try:
+		from yt_client import YouTubeClient
+		from response_cache import ResponseCache
+	except ImportError as exce:
+		progress("Skipping update benchmarks, gdata is needed! {0}".format(exce))
+		return
+	
+	server = StubFeedServer(options.channels, options.channel_videos, 25, 
+							vocabulary, options.seed + 2, options.latency)
+	server.start()
+	
+	cache_dir = tempfile.mkdtemp(prefix="subbox-bench-responses-")
+	
+	try:
+		marks_file = state_path(directory, "feeds")
+		
+		def setup():
+			if os.path.exists(directory):
+				shutil.rmtree(directory)
+			os.makedirs(directory)
+		
+		cases = (
+				("update.full", setup, None),
+				("update.unchanged", None, None),
+				("update.cached", setup, 3600),
+				("update.revalidated", setup, 0),
+				)
+		for name, reset, ttl in cases:
+			
+			response_cache = None
+			if ttl is not None:
+				response_cache = ResponseCache(cache_dir, ttl)
+			
+			client = YouTubeClient(rate=1000, response_cache=response_cache)
+			client.ssl = False
+			
+			counts = []
+			def update():
+				with server.lock:
+					server.requests = 0
+				added = run_update(client, server, 
+							open_index(directory, options.backend), 
+							FeedMarks(marks_file), options.threads, 
+							options.pages, 25)
+				counts.append((added, server.requests))
+			
+			# Each case starts from where the one before left off; the
+			# first update of the index, or of the cache, isn't timed.
+			if reset is None or name == "update.cached":
+				setup()
+				with quiet():
+					update()
+					
+			times = timed(update, options.repeat, reset)
+			results.record(name, options.channels * options.channel_videos, 
+							times, added=counts[-1][0], requests=counts[-1][1])
+	finally:
+		server.shutdown()
+		server.server_close()
+		shutil.rmtree(cache_dir)
+
+if __name__ == "__main__":
+	
+	option_parser = optparse.OptionParser(usage="python %prog [options]")
+	option_parser.add_option("--sizes", action="store", type="string", dest="sizes", default="1000,10000,100000", help="comma separated sizes of the synthetic indexes to benchmark")
+	option_parser.add_option("--repeat", action="store", type="int", dest="repeat", default=3, help="how many times to run each benchmark; the best and mean times are reported")
+	option_parser.add_option("--backend", action="store", type="string", dest="backend", default="directory", help="the video index backend to benchmark, 'directory' or 'sqlite'")
+	option_parser.add_option("--add-count", action="store", type="int", dest="add_count", default=1000, help="the number of entries to add when timing add()")
+	option_parser.add_option("--channels", action="store", type="int", dest="channels", default=20, help="the number of channels the stub feed server serves")
+	option_parser.add_option("--channel-videos", action="store", type="int", dest="channel_videos", default=100, help="the number of videos in each channel's feed")
+	option_parser.add_option("--latency", action="store", type="float", dest="latency", default=0.05, help="how long, in seconds, the stub feed server takes to respond to each request")
+	option_parser.add_option("--threads", action="store", type="int", dest="threads", default=8, help="the number of feeds to fetch concurrently when updating")
+	option_parser.add_option("--pages", action="store", type="int", dest="pages", default=4, help="the maximum number of pages to fetch from each feed when updating")
+	option_parser.add_option("--seed", action="store", type="int", dest="seed", default=0, help="seeds the generation of the synthetic indexes")
+	option_parser.add_option("--work-dir", action="store", type="string", dest="work_dir", default=None, help="where to generate the synthetic indexes; indexes already there are reused. Defaults to a temporary directory which is removed afterwards")
+	option_parser.add_option("-o", "--output", action="store", type="string", dest="output", default=None, help="the file to append results to, rather than stdout")
+	option_parser.add_option("--skip", action="store", type="string", dest="skip", default="", help="comma separated groups of benchmarks to skip: index, add or update")
+	
+	options, args = option_parser.parse_args()
+	
+	sizes = [int(size) for size in options.sizes.split(",") if size]
+	skip = set(options.skip.split(","))
+	
+	work_dir = options.work_dir or tempfile.mkdtemp(prefix="subbox-bench-")
+	output = open(options.output, "a") if options.output else sys.stdout
+	
+	results = Results(output, {
+					"started": time.time(),
+					"python": platform.python_version(),
+					"backend": options.backend,
+					"seed": options.seed,
+					})
+	
+	try:
+		vocabulary = Vocabulary(random.Random(options.seed))
+		
+		if "index" not in skip:
+			for size in sizes:
+				
+				directory = os.path.join(work_dir, 
+								"index-{0}-{1}".format(size, options.seed))
+				if os.path.isdir(directory):
+					progress("Reusing {0} entry index ...".format(size))
+				else:
+					progress("Generating {0} entry index ...".format(size))
+					vocabulary = generate_index(directory, size, options.seed)
+				
+				bench_index(results, directory, size, vocabulary, options)
+				bench_startup(results, directory, size, vocabulary, options)
+		
+		if "add" not in skip:
+			bench_add(results, os.path.join(work_dir, "add"), vocabulary, 
+						options)
+		
+		if "update" not in skip:
+			bench_update(results, os.path.join(work_dir, "update"), 
+							vocabulary, options)
+	finally:
+		if options.output:
+			output.close()
+		
+		if options.work_dir:
+			for name in ("add", "update"):
+				if os.path.isdir(os.path.join(work_dir, name)):
+					shutil.rmtree(os.path.join(work_dir, name))
+		else:
+			shutil.rmtree(work_dir)
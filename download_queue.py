@@ -0,0 +1,99 @@
+
+# Copyright (C) 2011 by Oliver Ainsworth
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import json
+import subprocess
+
+from worker_pool import imap_unordered
+from video_index import load_json, replace_file
+
+class DownloadQueue(object):
+	
+	def __init__(self, path, max_jobs=2, retries=2):
+		"""
+			A queue of download commands, run at most `max_jobs` at a
+			time, each retried up to `retries` times if it exits with a
+			non-zero status.
+			
+			The queue is persisted as JSON at `path` whenever it changes,
+			so if a batch is interrupted, the downloads that hadn't
+			finished are picked up again the next time it's loaded.
+		"""
+		
+		self.path = str(path)
+		self.max_jobs = max(1, int(max_jobs))
+		self.retries = max(0, int(retries))
+		self.jobs = load_json(self.path, list, "Download queue file")
+	
+	def __len__(self):
+		return len(self.jobs)
+	
+	def add(self, vid, cmd):
+		"""
+			Queues the shell command `cmd` to download the video `vid`.
+			If `vid` is already queued, its command is replaced.
+		"""
+		
+		self.jobs = [job for job in self.jobs if job["id"] != vid]
+		self.jobs.append({"id": vid, "cmd": cmd})
+		self.save()
+	
+	def save(self):
+		
+		replace_file(self.path, lambda queue_file: 
+						json.dump(self.jobs, queue_file, indent=4))
+	
+	def _run_job(self, job):
+		"""
+			Runs the command of `job` until it succeeds or has been
+			retried `retries` times. Returns its last exit status.
+		"""
+		
+		for attempt in xrange(self.retries + 1):
+			
+			if attempt:
+				print "Retrying download of {0} ({1} of {2}) ...".format(
+										job["id"], attempt, self.retries)
+			
+			status = subprocess.Popen(job["cmd"], shell=True).wait()
+			if status == 0:
+				break
+				
+		return status
+	
+	def run(self):
+		"""
+			Runs every queued download, blocking until they're all done.
+			Each job is dropped from the queue once it's finished,
+			successfully or not. Returns a generator yielding a tuple of
+			(video ID, exit status) as each finishes.
+		"""
+		
+		for job, status, exce in imap_unordered(self._run_job, 
+												list(self.jobs), self.max_jobs):
+			
+			self.jobs.remove(job)
+			self.save()
+			
+			if exce is not None:
+				raise exce
+			
+			yield job["id"], status
@@ -21,6 +21,29 @@
 
 import time
 import re
+import ast
+import operator
+
+# NumPy is optional. Without it, rules are always evaluated an entry
+# at a time. It's only imported once a rule is compiled, as it takes
+# longer to import than most actions, which have no use for it, take
+# to run.
+numpy = None
+
+def _import_numpy():
+	"""
+		Imports NumPy, if it hasn't been already, returning the module
+		or False if it's not available.
+	"""
+	
+	global numpy
+	if numpy is None:
+		try:
+			import numpy
+		except ImportError:
+			numpy = False
+	
+	return numpy
 
 def minutes(count=1): return count * 60
 def hours(count=1): return count * 60 * minutes()
@@ -28,11 +51,56 @@ def days(count=1): return count * 24 * hours()
 def weeks(count=1): return count * 7 * days()
 def months(count=1): return count * 4 * weeks()
 
+class Untranslatable(Exception):
+	pass
+
 class ExclusionRule(object):
+	
+	# Maps ast comparison operators to the functions implementing them;
+	# these work element-wise when given NumPy arrays.
+	compare_ops = {
+				ast.Lt: operator.lt,
+				ast.LtE: operator.le,
+				ast.Gt: operator.gt,
+				ast.GtE: operator.ge,
+				ast.Eq: operator.eq,
+				ast.NotEq: operator.ne,
+				}
+	
+	# Entry attributes which can be compared as a column, and the
+	# NumPy dtype used for them.
+	scalar_columns = {
+				"date_published": float,
+				"title": object,
+				"description": object,
+				"category": object,
+				"uri": object,
+				"id": object,
+				}
 		
 	def __init__(self, expression):
+		"""
+			A rule, written as a Python expression, which decides whether
+			an entry should be excluded from the index. The expression is
+			compiled once, here, and can then be evaluated against any
+			number of entries.
+			
+			now() is frozen at the time the rule is created, so every
+			entry is judged against the same point in time.
+			
+			Raises SyntaxError if `expression` isn't a valid expression
+			and ValueError if it refers to any names other than `entry`,
+			those in `vars` and those bound within it by comprehensions
+			and lambdas, or to any private attributes.
+			
+			That check is there to catch typos before a rule is run
+			against a whole index; it is NOT a sandbox. A rule can still
+			reach just about anything, e.g. through `re`, so only rules
+			from trusted sources should be evaluated.
+		"""
 
 		self.expression = str(expression)
+		self.created = time.time()
 		self.vars = {
 					# Builtins we want to keep
 					"True": True,
@@ -43,7 +111,7 @@ class ExclusionRule(object):
 					# Other stuff
 					"all": True,
 					"force": False,
-					"now": time.time,
+					"now": lambda: self.created,
 					"minutes": minutes,
 					"hours": hours,
 					"days": days,
@@ -51,7 +119,364 @@ class ExclusionRule(object):
 					"months": months,
 					}
 		
+		tree = ast.parse(self.expression, "<rule>", "eval")
+		
+		# Names bound by comprehensions and lambdas, e.g. `t` in 
+		# `sum([1 for t in entry.tags if t == 'x'])`, are stored to or
+		# are parameters; anything else must be known beforehand.
+		bound = set([node.id for node in ast.walk(tree) 
+						if isinstance(node, ast.Name) and 
+							isinstance(node.ctx, (ast.Store, ast.Param))])
+		
+		for node in ast.walk(tree):
+			if isinstance(node, ast.Name):
+				if (node.id != "entry" and node.id not in self.vars and
+						node.id not in bound):
+					raise ValueError(
+						"unknown name '{0}' in rule".format(node.id))
+			elif isinstance(node, ast.Attribute):
+				if node.attr.startswith("_"):
+					raise ValueError(
+						"private attribute '{0}' in rule".format(node.attr))
+		
+		self.code = compile(tree, "<rule>", "eval")
+		
+		# Common rule shapes can be evaluated over whole columns of
+		# entry attributes at once. Anything else, or everything if 
+		# NumPy isn't available, falls back to evaluate()-ing each entry.
+		self.predicate = None
+		if _import_numpy():
+			try:
+				self.predicate = self._translate_predicate(tree.body)
+			except Untranslatable:
+				pass
+		
 	def evaluate(self, entry):
 		
 		context_dict = dict({"__builtins__": None, "entry": entry}, **self.vars)
-		return bool(eval(self.expression, context_dict, {}))
+		return bool(eval(self.code, context_dict))
+	
+	def filter(self, entries):
+		"""
+			Returns a list of those of `entries` which match the rule.
+			Cheaper than calling evaluate() for each as the evaluation
+			context is only built once, and, if the rule could be
+			translated to operate on columns, it's evaluated for all
+			the entries at once.
+		"""
+		
+		entries = list(entries)
+		context_dict = dict({"__builtins__": None}, **self.vars)
+		
+		if self.predicate is not None and entries:
+			try:
+				return self._filter_columns(entries, context_dict)
+			except (TypeError, ValueError):
+				# Most likely an attribute holding something unexpected;
+				# the slow path will deal with it like it always has.
+				pass
+		
+		matches = []
+		for entry in entries:
+			context_dict["entry"] = entry
+			if eval(self.code, context_dict):
+				matches.append(entry)
+				
+		return matches
+	
+	def _filter_columns(self, entries, context_dict):
+		
+		columns = {}
+		def column(attr):
+			if attr not in columns:
+				values = [getattr(entry, attr) for entry in entries]
+				if attr in self.__class__.scalar_columns:
+					array = numpy.empty(len(values), 
+								dtype=self.__class__.scalar_columns[attr])
+					array[:] = values
+					values = array
+				columns[attr] = values
+			return columns[attr]
+		
+		mask = numpy.asarray(self.predicate(column, context_dict), dtype=bool)
+		if mask.shape == ():
+			return entries if mask else []
+			
+		return [entry for entry, match in zip(entries, mask) if match]
+	
+	def _entry_attribute(self, node):
+		"""
+			Returns the attribute name if `node` is of the form
+			`entry.attribute`, otherwise None.
+		"""
+		
+		if (isinstance(node, ast.Attribute) and 
+				isinstance(node.value, ast.Name) and node.value.id == "entry"):
+			return node.attr
+			
+		return None
+	
+	def _translate_constant(self, node):
+		"""
+			Returns a function evaluating `node` in the rule's context
+			if it doesn't depend on the entry, else raises Untranslatable.
+		"""
+		
+		for child in ast.walk(node):
+			if isinstance(child, ast.Name) and child.id == "entry":
+				raise Untranslatable()
+		
+		code = compile(ast.Expression(node), "<rule>", "eval")
+		return lambda column, context: eval(code, context)
+	
+	def _translate_predicate(self, node):
+		"""
+			Translates the boolean expression `node` into a function
+			which, given a function returning the column of values for
+			an entry attribute and the evaluation context, returns an
+			array of booleans, one per entry. Raises Untranslatable if
+			`node` isn't of a supported shape.
+		"""
+		
+		if isinstance(node, ast.BoolOp):
+			operands = [self._translate_predicate(value) 
+							for value in node.values]
+			if isinstance(node.op, ast.And):
+				combine = numpy.logical_and
+			else:
+				combine = numpy.logical_or
+			return lambda column, context: reduce(combine,
+							[operand(column, context) for operand in operands])
+		
+		elif isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.Not):
+			operand = self._translate_predicate(node.operand)
+			return lambda column, context: numpy.logical_not(
+												operand(column, context))
+		
+		elif isinstance(node, ast.Compare):
+			return self._translate_compare(node)
+			
+		elif isinstance(node, ast.Call):
+			return self._translate_regex(node)
+			
+		return self._translate_constant(node)
+	
+	def _translate_compare(self, node):
+		
+		# Chained comparisons, e.g. a < b < c, are the conjunction of
+		# each pair of neighbouring operands.
+		operands = [node.left] + list(node.comparators)
+		comparisons = []
+		for op, left, right in zip(node.ops, operands, operands[1:]):
+			
+			if isinstance(op, (ast.In, ast.NotIn)):
+				comparison = self._translate_membership(left, right)
+				if isinstance(op, ast.NotIn):
+					comparison = (lambda comparison: 
+						lambda column, context: numpy.logical_not(
+										comparison(column, context)))(comparison)
+			elif type(op) in self.__class__.compare_ops:
+				comparison = (lambda function, left, right:
+					lambda column, context: function(
+										left(column, context),
+										right(column, context)))(
+							self.__class__.compare_ops[type(op)],
+							self._translate_scalar(left),
+							self._translate_scalar(right))
+			else:
+				raise Untranslatable()
+				
+			comparisons.append(comparison)
+		
+		return lambda column, context: reduce(numpy.logical_and,
+						[comparison(column, context) 
+							for comparison in comparisons])
+	
+	def _translate_scalar(self, node):
+		
+		attr = self._entry_attribute(node)
+		if attr is not None:
+			if attr not in self.__class__.scalar_columns:
+				raise Untranslatable()
+			return lambda column, context: column(attr)
+			
+		return self._translate_constant(node)
+	
+	def _translate_membership(self, left, right):
+		"""
+			Supports `value in entry.attribute`, e.g. tag membership,
+			and `entry.attribute in values`.
+		"""
+		
+		attr = self._entry_attribute(right)
+		if attr is not None:
+			value = self._translate_constant(left)
+			def membership(column, context):
+				value_ = value(column, context)
+				return numpy.fromiter((value_ in values 
+									for values in column(attr)), bool)
+			return membership
+		
+		attr = self._entry_attribute(left)
+		if attr is not None:
+			values = self._translate_constant(right)
+			def membership(column, context):
+				values_ = values(column, context)
+				return numpy.fromiter((value in values_ 
+									for value in column(attr)), bool)
+			return membership
+			
+		raise Untranslatable()
+	
+	def _translate_regex(self, node):
+		"""
+			Supports `re.search(pattern, entry.attribute)` and likewise
+			for re.match, where `pattern` doesn't depend on the entry.
+		"""
+		
+		func = node.func
+		if (not isinstance(func, ast.Attribute) or
+				not isinstance(func.value, ast.Name) or
+				func.value.id != "re" or
+				func.attr not in ("search", "match") or
+				len(node.args) != 2 or node.keywords or
+				getattr(node, "starargs", None) or
+				getattr(node, "kwargs", None)):
+			raise Untranslatable()
+		
+		pattern = self._translate_constant(node.args[0])
+		attr = self._entry_attribute(node.args[1])
+		if attr is None:
+			raise Untranslatable()
+		
+		def regex(column, context):
+			method = getattr(re.compile(pattern(column, context)), func.attr)
+			return numpy.fromiter((method(value) is not None 
+									for value in column(attr)), bool)
+		return regex
+	
+	# Maps ast comparison operators to their SQL equivalents.
+	sql_compare_ops = {
+				ast.Lt: "<",
+				ast.LtE: "<=",
+				ast.Gt: ">",
+				ast.GtE: ">=",
+				ast.Eq: "=",
+				ast.NotEq: "!=",
+				}
+	
+	def sql_condition(self):
+		"""
+			Translates the rule into an SQL condition, e.g. for a WHERE
+			clause, over a table with a column named after each of the
+			attributes in `scalar_columns`. Returns a (condition, 
+			parameters) tuple.
+			
+			Only comparisons of those attributes with each other or with
+			values which don't depend on the entry, combined with and,
+			or and not, can be translated; anything else raises
+			Untranslatable.
+		"""
+		
+		context = dict({"__builtins__": None}, **self.vars)
+		tree = ast.parse(self.expression, "<rule>", "eval")
+		
+		return self._translate_sql(tree.body, context)
+	
+	def _translate_sql(self, node, context):
+		
+		if isinstance(node, ast.BoolOp):
+			operands = [self._translate_sql(value, context) 
+							for value in node.values]
+			joiner = " AND " if isinstance(node.op, ast.And) else " OR "
+			return (joiner.join(["(" + condition + ")" 
+									for condition, params in operands]),
+						sum([params for condition, params in operands], []))
+		
+		elif isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.Not):
+			condition, params = self._translate_sql(node.operand, context)
+			return ("NOT (" + condition + ")", params)
+		
+		elif (isinstance(node, ast.Compare) and 
+				[child for child in ast.walk(node) 
+					if isinstance(child, ast.Name) and child.id == "entry"]):
+			
+			operands = [node.left] + list(node.comparators)
+			conditions = []
+			params = []
+			for op, left, right in zip(node.ops, operands, operands[1:]):
+				
+				if isinstance(op, (ast.In, ast.NotIn)):
+					column, type_ = self._sql_column(left)
+					values = self._translate_constant(right)(None, context)
+					if not isinstance(values, (list, tuple, set, frozenset)):
+						raise Untranslatable()
+					values = [self._sql_value(value, type_) for value in values]
+					
+					condition = "{0} IN ({1})".format(column, 
+											", ".join(["?"] * len(values)))
+					if isinstance(op, ast.NotIn):
+						condition = "NOT " + condition
+					conditions.append(condition)
+					params.extend(values)
+					continue
+				
+				if type(op) not in self.__class__.sql_compare_ops:
+					raise Untranslatable()
+				
+				sides = []
+				types = set()
+				for operand, other in ((left, right), (right, left)):
+					if self._entry_attribute(operand) is not None:
+						column, type_ = self._sql_column(operand)
+						sides.append((column, []))
+						types.add(type_)
+					else:
+						column, type_ = self._sql_column(other)
+						value = self._translate_constant(operand)(None, context)
+						sides.append(("?", [self._sql_value(value, type_)]))
+				
+				if len(types) > 1:
+					raise Untranslatable()
+				
+				conditions.append("{0} {1} {2}".format(sides[0][0], 
+								self.__class__.sql_compare_ops[type(op)], 
+								sides[1][0]))
+				params.extend(sides[0][1] + sides[1][1])
+			
+			return (" AND ".join(conditions), params)
+		
+		# Anything else must not depend on the entry, so it's the same
+		# for every row.
+		value = self._translate_constant(node)(None, context)
+		return ("1" if value else "0", [])
+	
+	def _sql_column(self, node):
+		"""
+			Returns the (column, type) of `node`, which must be of the 
+			form `entry.attribute` for one of `scalar_columns`.
+		"""
+		
+		attr = self._entry_attribute(node)
+		if attr not in self.__class__.scalar_columns:
+			raise Untranslatable()
+			
+		return (attr, self.__class__.scalar_columns[attr])
+	
+	def _sql_value(self, value, type_):
+		"""
+			Returns `value` as a parameter for comparing to a column of
+			`type_`. Values of other types compare differently in SQL
+			than in Python, so they raise Untranslatable.
+		"""
+		
+		if type_ is float:
+			if (isinstance(value, (int, long, float)) and 
+					not isinstance(value, bool)):
+				return value
+		elif isinstance(value, str):
+			return value
+		elif isinstance(value, unicode):
+			return value.encode("utf-8")
+			
+		raise Untranslatable()
@@ -0,0 +1,66 @@
+
+# Copyright (C) 2011 by Oliver Ainsworth
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import json
+
+from video_index import load_json, replace_file
+
+class FeedMarks(object):
+	
+	def __init__(self, path):
+		"""
+			The 'high-water marks' of each feed fetched when updating,
+			stored as a JSON file at `path`. For each feed URI it
+			records:
+			
+				checked		- the time, in seconds since the epoch, the
+							feed was last successfully fetched
+				latest		- the date_published of the newest video
+							seen in the feed
+							
+			If `path` doesn't exist or can't be parsed, no marks are
+			loaded and it will be (re)created by save().
+		"""
+		
+		self.path = str(path)
+		self.marks = load_json(self.path, dict, "Feed marks file")
+	
+	def checked(self, feed):
+		return self.marks.get(feed, {}).get("checked")
+	
+	def latest(self, feed):
+		return self.marks.get(feed, {}).get("latest", 0.0)
+	
+	def mark(self, feed, checked, latest=None):
+		"""
+			Records that `feed` was fetched at `checked`. The latest
+			mark is only ever moved forward.
+		"""
+		
+		self.marks[feed] = {
+						"checked": checked,
+						"latest": max(latest or 0.0, self.latest(feed)),
+						}
+	
+	def save(self):
+		
+		replace_file(self.path, lambda marks_file: 
+						json.dump(self.marks, marks_file, indent=4))
@@ -0,0 +1,294 @@
+
+# Copyright (C) 2011 by Oliver Ainsworth
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import os
+import json
+import socket
+import SocketServer
+
+from video_index import VideoIndexEntry, utf8
+from exclusion_rule import ExclusionRule
+
+class RemoteError(Exception):
+	"""
+		Raised by RemoteIndex when the server couldn't carry out a
+		request; the message is the server's.
+	"""
+
+def entry_state(entry):
+	"""
+		Returns what a RemoteIndex needs to recreate `entry`; its meta,
+		less the description, and directory.
+	"""
+	
+	meta = {}
+	for key, attr_name in VideoIndexEntry.keys_map.iteritems():
+		if key != "description":
+			meta[key] = getattr(entry, attr_name)
+	
+	return {"meta": meta, "directory": entry.directory}
+
+class IndexRequestHandler(SocketServer.StreamRequestHandler):
+	
+	def handle(self):
+		
+		# Each connection carries a single request, a line of JSON, and
+		# its response, another.
+		try:
+			request = json.loads(self.rfile.readline())
+			handler = getattr(self.server, "do_" + str(request["action"]))
+			response = {"result": handler(**dict([(str(key), value) 
+									for key, value in request["args"].iteritems()]))}
+		except Exception as exce:
+			response = {"error": "{0}: {1}".format(type(exce).__name__, exce)}
+		
+		self.wfile.write(json.dumps(response) + "\n")
+
+class IndexServer(SocketServer.UnixStreamServer):
+	
+	def __init__(self, path, index, watcher=None):
+		"""
+			Serves the VideoIndex `index`, kept in memory, to RemoteIndex
+			clients over a Unix domain socket at `path`. Requests are
+			handled one at a time, so the index is never used by more
+			than one at once.
+			
+			If `watcher`, an IndexWatcher of `index`, is given, changes
+			it's seen are applied to the index before each request.
+			
+			If `path` is left over from a server which has since died,
+			it's replaced. If a server is still running there, 
+			socket.error is raised.
+		"""
+		
+		if os.path.exists(path):
+			if RemoteIndex.connect(path) is not None:
+				raise socket.error("the index is already being served")
+			os.remove(path)
+		
+		SocketServer.UnixStreamServer.__init__(self, path, IndexRequestHandler)
+		
+		self.path = path
+		self.index = index
+		self.watcher = watcher
+	
+	def process_request(self, request, client_address):
+		
+		if self.watcher is not None:
+			self.watcher.apply()
+		
+		SocketServer.UnixStreamServer.process_request(self, request, 
+															client_address)
+	
+	def server_bind(self):
+		
+		# Anyone who can connect can have a rule evaluated, which is as
+		# good as running code as whoever is serving, so the socket is
+		# only usable by them. It's created that way, rather than
+		# changed afterwards, so there's no moment anyone else can
+		# connect.
+		umask = os.umask(0177)
+		try:
+			SocketServer.UnixStreamServer.server_bind(self)
+		finally:
+			os.umask(umask)
+		os.chmod(self.server_address, 0600)
+	
+	def close(self):
+		
+		self.server_close()
+		if self.watcher is not None:
+			self.watcher.close()
+		try:
+			os.remove(self.path)
+		except OSError:
+			pass
+	
+	# Requests are answered by the do_<action>() method of the same name,
+	# with the request's arguments. What it returns is the result.
+	
+	def do_ping(self):
+		return True
+	
+	def do_search(self, query, threshold, limit):
+		return [entry_state(entry) for entry in 
+						self.index.search(query, threshold, limit)]
+	
+	def do_entries(self, vids):
+		
+		# Entries are resynchronised first, so they're never stale.
+		self.index.sync(vids)
+		return [entry_state(self.index[vid]) for vid in vids 
+					if vid in self.index]
+	
+	def do_description(self, vid):
+		return self.index[vid].description
+	
+	def do_partial_downloads(self):
+		return [entry_state(entry) for entry in self.index.partial_downloads()]
+	
+	def do_complete_download(self, vid):
+		self.index.complete_download(vid)
+	
+	def do_restore_media(self, vid):
+		return self.index.restore_media(vid)
+	
+	def do_matching(self, expression):
+		return self.index.matching(ExclusionRule(expression))
+	
+	def do_delete(self, vid):
+		self.index.delete(vid)
+	
+	def do_sync(self, vids=None):
+		self.index.sync(vids)
+
+class RemoteIndexEntry(VideoIndexEntry):
+	
+	__slots__ = ("index",)
+	
+	def __init__(self, index, directory, meta):
+		"""
+			A VideoIndexEntry of a RemoteIndex `index`. Its description
+			is asked for from the server when needed.
+		"""
+		
+		VideoIndexEntry.__init__(self, directory, meta)
+		self.index = index
+	
+	def _load_description(self):
+		return utf8(self.index.request("description", vid=self.id))
+
+class RemoteIndex(object):
+	
+	def __init__(self, path):
+		"""
+			A stand-in for a VideoIndex being served by an IndexServer
+			at `path`. Only supports what the actions which can be
+			served need: search(), sync() of specific IDs and looking
+			up the entries synchronised, partial_downloads(),
+			complete_download(), restore_media(), matching() and
+			delete().
+			
+			Use connect() to find out whether there's a server at all.
+		"""
+		
+		self.path = str(path)
+		self.videos = {}
+	
+	@classmethod
+	def connect(cls, path):
+		"""
+			Returns a RemoteIndex for the server at `path`, or None if
+			there isn't one running.
+		"""
+		
+		index = cls(path)
+		try:
+			index.request("ping")
+		except socket.error:
+			return None
+			
+		return index
+	
+	def request(self, action, **args):
+		"""
+			Sends a request to the server, returning its result. Raises
+			socket.error if the server can't be reached and RemoteError
+			if it couldn't carry out the request.
+		"""
+		
+		connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+		try:
+			connection.connect(self.path)
+			connection.sendall(json.dumps({"action": action, 
+											"args": args}) + "\n")
+			
+			response_file = connection.makefile("r")
+			try:
+				response = json.loads(response_file.readline() or "null")
+			finally:
+				response_file.close()
+		except ValueError:
+			raise socket.error("malformed response from the server")
+		finally:
+			connection.close()
+		
+		if not isinstance(response, dict):
+			raise socket.error("malformed response from the server")
+		if "error" in response:
+			raise RemoteError(response["error"])
+		
+		return response["result"]
+	
+	def _entry(self, state):
+		return RemoteIndexEntry(self, state["directory"], state["meta"])
+	
+	def __getitem__(self, name):
+		return self.videos[name]
+	
+	def __contains__(self, obj):
+		return obj in self.videos
+	
+	def sync(self, vids=None):
+		"""
+			Fetches the entries with the IDs `vids` from the server. The
+			server already has the whole index loaded, so without `vids`
+			there's nothing to do; see resync() to have the server sync.
+		"""
+		
+		if vids is None:
+			return
+		
+		for vid in vids:
+			self.videos.pop(str(vid), None)
+			
+		for state in self.request("entries", vids=[str(vid) for vid in vids]):
+			entry = self._entry(state)
+			self.videos[entry.id] = entry
+	
+	def resync(self, vids=None):
+		"""
+			Has the server synchronise its index, e.g. after it's been
+			changed by something else.
+		"""
+		
+		self.request("sync", vids=vids)
+	
+	def search(self, query, threshold=0.25, limit=None):
+		return [self._entry(state) for state in self.request("search", 
+							query=query, threshold=threshold, limit=limit)]
+	
+	def partial_downloads(self):
+		return [self._entry(state) 
+					for state in self.request("partial_downloads")]
+	
+	def complete_download(self, vid):
+		self.request("complete_download", vid=vid)
+	
+	def restore_media(self, vid):
+		return self.request("restore_media", vid=vid)
+	
+	def matching(self, rule):
+		return self.request("matching", expression=rule.expression)
+	
+	def delete(self, vid):
+		self.request("delete", vid=vid)
+		self.videos.pop(vid, None)
@@ -0,0 +1,322 @@
+
+# Copyright (C) 2011 by Oliver Ainsworth
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import os
+import stat
+import time
+import errno
+import struct
+
+# The files within an entry directory whose changes matter; the rest,
+# e.g. the temporary file a meta file is written to, are ignored.
+META_NAMES = ("meta",)
+MEDIA_NAMES = ("media", "media.part")
+
+def watch(index, interval=5):
+	"""
+		Returns an InotifyWatcher for the VideoIndex `index` if inotify
+		is available, otherwise a PollingWatcher which checks it every
+		`interval` seconds at most.
+	"""
+	
+	try:
+		return InotifyWatcher(index)
+	except (OSError, ImportError, AttributeError):
+		return PollingWatcher(index, interval)
+
+class IndexWatcher(object):
+	
+	def __init__(self, index):
+		"""
+			Keeps the in-memory VideoIndex `index` up to date with
+			changes made to its entry directories by other processes,
+			without a full sync().
+			
+			Nothing is applied until apply() is called, so the index is
+			only ever changed by whoever is using it. The index should
+			already have been synchronised.
+		"""
+		
+		self.index = index
+	
+	def changes(self):
+		"""
+			Returns a dictionary mapping the IDs of the entries which
+			have changed since the last call to either "meta", if the
+			entry may have been added, removed or had its meta changed,
+			or "media", if only its media may have. Returns None if
+			track of what's changed has been lost.
+		"""
+		
+		raise NotImplementedError
+	
+	def apply(self):
+		"""
+			Applies any changes made since the last call to the index.
+			Entries whose meta has changed are synchronised again and
+			those whose media has changed have its state looked up
+			again. Returns the IDs of the entries changed.
+		"""
+		
+		changes = self.changes()
+		if changes is None:
+			self.index.sync()
+			return [vid for vid, entry in self.index]
+		
+		resync = [vid for vid, change in changes.iteritems() 
+					if change == "meta" or vid not in self.index]
+		if resync:
+			self.index.sync(resync)
+		
+		self.index.refresh_media([vid for vid, change in changes.iteritems()
+									if change == "media"])
+		
+		return changes.keys()
+	
+	def close(self):
+		pass
+
+class PollingWatcher(IndexWatcher):
+	
+	def __init__(self, index, interval=5):
+		"""
+			An IndexWatcher which finds changes by looking at the mtimes
+			of the entry directories and meta files. That's two stats an
+			entry, so it's done every `interval` seconds at most; calls
+			to apply() in between do nothing.
+		"""
+		
+		IndexWatcher.__init__(self, index)
+		
+		self.interval = interval
+		self.state = self._scan()
+		self.scanned = time.time()
+	
+	def _scan(self):
+		"""
+			Returns a dictionary mapping the name of each entry directory
+			to its mtime and the mtime and size of its meta file.
+		"""
+		
+		state = {}
+		for vid in os.listdir(self.index.directory):
+			if vid.startswith("."):
+				continue
+			
+			directory = os.path.join(self.index.directory, vid)
+			try:
+				dir_stat = os.stat(directory)
+			except OSError:
+				continue
+			if not stat.S_ISDIR(dir_stat.st_mode):
+				continue
+			
+			try:
+				meta_stat = os.stat(os.path.join(directory, "meta"))
+				meta_key = (meta_stat.st_mtime, meta_stat.st_size)
+			except OSError:
+				meta_key = None
+				
+			state[vid] = (dir_stat.st_mtime, meta_key)
+		
+		return state
+	
+	def changes(self):
+		
+		if time.time() - self.scanned < self.interval:
+			return {}
+		
+		state = self._scan()
+		self.scanned = time.time()
+		
+		# Any file being added, removed or renamed over changes the
+		# mtime of the directory it's in. Without knowing which it was,
+		# the media is looked up again unless the meta has changed too.
+		changes = {}
+		for vid in set(state) | set(self.state):
+			old, new = self.state.get(vid), state.get(vid)
+			if old is None or new is None or old[1] != new[1]:
+				changes[vid] = "meta"
+			elif old[0] != new[0]:
+				changes[vid] = "media"
+		
+		self.state = state
+		return changes
+
+class InotifyWatcher(IndexWatcher):
+	
+	# From <sys/inotify.h>.
+	IN_CLOSE_WRITE = 0x00000008
+	IN_MOVED_FROM = 0x00000040
+	IN_MOVED_TO = 0x00000080
+	IN_CREATE = 0x00000100
+	IN_DELETE = 0x00000200
+	IN_Q_OVERFLOW = 0x00004000
+	IN_IGNORED = 0x00008000
+	IN_ONLYDIR = 0x01000000
+	IN_ISDIR = 0x40000000
+	IN_CLOEXEC = 0o2000000
+	IN_NONBLOCK = 0o4000
+	
+	event_header = struct.Struct("iIII")
+	
+	def __init__(self, index):
+		"""
+			An IndexWatcher which is told of changes by the kernel, via
+			inotify, rather than looking for them. Each entry directory
+			takes up a watch; if there aren't enough to go round, or
+			inotify isn't available at all, OSError is raised.
+		"""
+		
+		# ctypes is imported here, rather than up top, as it's slow to
+		# import and only needed on Linux.
+		import ctypes
+		import ctypes.util
+		
+		IndexWatcher.__init__(self, index)
+		
+		self.libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+		self.fd = self.libc.inotify_init1(self.__class__.IN_NONBLOCK | 
+											self.__class__.IN_CLOEXEC)
+		if self.fd < 0:
+			self._raise()
+		
+		# Maps watch descriptors to the ID of the entry directory they
+		# watch, or None for the index directory itself.
+		self.watches = {}
+		
+		try:
+			self._watch(None)
+			for vid in os.listdir(self.index.directory):
+				if not vid.startswith("."):
+					self._watch(vid)
+		except OSError:
+			self.close()
+			raise
+	
+	def _raise(self):
+		
+		import ctypes
+		code = ctypes.get_errno()
+		raise OSError(code, os.strerror(code))
+	
+	def _watch(self, vid):
+		"""
+			Adds a watch for the entry directory `vid`, or the index
+			directory if None. Entries which have gone already are
+			ignored; see changes().
+		"""
+		
+		cls = self.__class__
+		if vid is None:
+			path = self.index.directory
+			mask = cls.IN_CREATE | cls.IN_DELETE | cls.IN_MOVED_FROM | \
+					cls.IN_MOVED_TO
+		else:
+			path = os.path.join(self.index.directory, vid)
+			mask = cls.IN_CREATE | cls.IN_DELETE | cls.IN_MOVED_FROM | \
+					cls.IN_MOVED_TO | cls.IN_CLOSE_WRITE | cls.IN_ONLYDIR
+		
+		wd = self.libc.inotify_add_watch(self.fd, path, mask)
+		if wd < 0:
+			try:
+				self._raise()
+			except OSError as exce:
+				if exce.errno not in (errno.ENOENT, errno.ENOTDIR):
+					raise
+				return
+		
+		self.watches[wd] = vid
+	
+	def _read(self):
+		"""
+			Returns all of the events waiting to be read as a list of
+			(watch descriptor, mask, name) tuples.
+		"""
+		
+		data = ""
+		while True:
+			try:
+				chunk = os.read(self.fd, 64 * 1024)
+			except OSError as exce:
+				if exce.errno == errno.EAGAIN:
+					break
+				raise
+			if not chunk:
+				break
+			data += chunk
+		
+		events = []
+		offset = 0
+		header = self.__class__.event_header
+		while offset < len(data):
+			wd, mask, cookie, length = header.unpack_from(data, offset)
+			offset += header.size
+			name = data[offset:offset + length].rstrip("\0")
+			offset += length
+			events.append((wd, mask, name))
+		
+		return events
+	
+	def changes(self):
+		
+		cls = self.__class__
+		changes = {}
+		
+		for wd, mask, name in self._read():
+			
+			if mask & cls.IN_Q_OVERFLOW:
+				# Events have been dropped, so everything is looked at
+				# again. Any new entry directories need watching too.
+				for vid in os.listdir(self.index.directory):
+					if not vid.startswith("."):
+						self._watch(vid)
+				return None
+			
+			if mask & cls.IN_IGNORED:
+				self.watches.pop(wd, None)
+				continue
+			
+			if wd not in self.watches or name.startswith("."):
+				continue
+			
+			vid = self.watches[wd]
+			if vid is None:
+				# An entry directory being added or removed. New ones
+				# are watched straight away; the meta may well have been
+				# written already, so they're synchronised regardless.
+				if not mask & cls.IN_ISDIR:
+					continue
+				if mask & (cls.IN_CREATE | cls.IN_MOVED_TO):
+					self._watch(name)
+				changes[name] = "meta"
+			elif name in META_NAMES:
+				changes[vid] = "meta"
+			elif name in MEDIA_NAMES:
+				changes.setdefault(vid, "media")
+		
+		return changes
+	
+	def close(self):
+		
+		if self.fd >= 0:
+			os.close(self.fd)
+			self.fd = -1
@@ -0,0 +1,92 @@
+
+# Copyright (C) 2011 by Oliver Ainsworth
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import os
+
+class MediaStore(object):
+	
+	def __init__(self, directory):
+		"""
+			A content-addressed store of media files, each stored once
+			under `directory` by its SHA-1 checksum. Entries reference
+			stored media by hard links, so identical media downloaded for
+			several entries only takes up space once.
+			
+			A stored file's link count doubles as its reference count;
+			once only the store's own link is left, it's removed.
+		"""
+		
+		self.directory = str(directory)
+	
+	def path(self, sha1):
+		return os.path.join(self.directory, sha1[:2], sha1)
+	
+	def add(self, media_file, sha1):
+		"""
+			Stores the file `media_file`, whose checksum is `sha1`. If
+			identical media is already stored, `media_file` is replaced
+			with a link to it. Returns False if the file couldn't be
+			linked, e.g. the file system doesn't support hard links.
+		"""
+		
+		stored = self.path(sha1)
+		try:
+			if not os.path.exists(stored):
+				if not os.path.isdir(os.path.dirname(stored)):
+					os.makedirs(os.path.dirname(stored))
+				os.link(media_file, stored)
+			elif not os.path.samefile(media_file, stored):
+				tmp_file = media_file + ".tmp"
+				os.link(stored, tmp_file)
+				os.rename(tmp_file, media_file)
+		except OSError as exce:
+			print "Warning: Can't add {0} to the media store! {1}".format(
+														media_file, exce)
+			return False
+			
+		return True
+	
+	def restore(self, sha1, media_file):
+		"""
+			Links the stored media with the checksum `sha1` to
+			`media_file`. Returns whether it was stored.
+		"""
+		
+		try:
+			os.link(self.path(sha1), media_file)
+		except OSError:
+			return False
+			
+		return True
+	
+	def release(self, sha1):
+		"""
+			To be called when a link to the stored media with the checksum
+			`sha1` has been removed. Removes it from the store if nothing
+			else links to it.
+		"""
+		
+		stored = self.path(sha1)
+		try:
+			if os.stat(stored).st_nlink <= 1:
+				os.remove(stored)
+		except OSError:
+			pass
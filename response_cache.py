@@ -0,0 +1,164 @@
+
+# Copyright (C) 2011 by Oliver Ainsworth
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import os
+import json
+import time
+import hashlib
+import threading
+
+from video_index import replace_file
+
+class ResponseCache(object):
+	
+	def __init__(self, directory, ttl=900, max_size=100 * 1024 * 1024):
+		"""
+			A cache of HTTP responses, stored as a file per URI in
+			`directory`. A cached response is fresh for `ttl` seconds
+			after it was stored or last revalidated; after that it must
+			be revalidated with the server before being used again.
+			
+			Once the cache grows past `max_size` bytes, the least
+			recently used responses are evicted. Safe to use from
+			several threads.
+		"""
+		
+		self.directory = str(directory)
+		self.ttl = ttl
+		self.max_size = max_size
+		
+		# The total size is only worked out once something is stored.
+		self.size = None
+		self.lock = threading.Lock()
+	
+	def path(self, uri):
+		return os.path.join(self.directory, hashlib.sha1(uri).hexdigest())
+	
+	def lookup(self, uri):
+		"""
+			Returns the cached response for `uri` as a dict of its body,
+			validators (etag and last_modified) and the time it was
+			stored, or None if there isn't one.
+		"""
+		
+		path = self.path(uri)
+		try:
+			with open(path, "rb") as cache_file:
+				cached = json.loads(cache_file.readline())
+				cached["body"] = cache_file.read()
+		except (IOError, ValueError):
+			return None
+		
+		if cached.get("uri") != uri:
+			return None
+		
+		# A file's mtime is when it was last used, for eviction.
+		try:
+			os.utime(path, None)
+		except OSError:
+			pass
+			
+		return cached
+	
+	def fresh(self, cached):
+		return time.time() - cached["stored"] < self.ttl
+	
+	def store(self, uri, body, etag=None, last_modified=None):
+		
+		if len(body) > self.max_size:
+			return
+		
+		path = self.path(uri)
+		header = json.dumps({
+					"uri": uri,
+					"etag": etag,
+					"last_modified": last_modified,
+					"stored": time.time(),
+					})
+		
+		with self.lock:
+			
+			if self.size is None:
+				self.size = self._measure()
+			
+			try:
+				if not os.path.isdir(self.directory):
+					os.makedirs(self.directory)
+				
+				try:
+					self.size -= os.path.getsize(path)
+				except OSError:
+					pass
+				
+				def write(cache_file):
+					cache_file.write(header + "\n")
+					cache_file.write(body)
+				replace_file(path, write)
+				self.size += len(header) + 1 + len(body)
+			except (IOError, OSError) as exce:
+				print "Warning: Can't write to the response cache! {0}".format(exce)
+				return
+			
+			if self.size > self.max_size:
+				self._evict()
+	
+	def _measure(self):
+		
+		try:
+			names = os.listdir(self.directory)
+		except OSError:
+			return 0
+		
+		size = 0
+		for name in names:
+			try:
+				size += os.path.getsize(os.path.join(self.directory, name))
+			except OSError:
+				pass
+		
+		return size
+	
+	def _evict(self):
+		"""
+			Removes the least recently used responses until the cache is
+			back down to three quarters of max_size. Must be called with
+			the lock held.
+		"""
+		
+		files = []
+		for name in os.listdir(self.directory):
+			try:
+				stat = os.stat(os.path.join(self.directory, name))
+			except OSError:
+				continue
+			files.append((stat.st_mtime, stat.st_size, name))
+		
+		files.sort()
+		self.size = sum([size for mtime, size, name in files])
+		
+		for mtime, size, name in files:
+			if self.size <= self.max_size * 3 / 4:
+				break
+			try:
+				os.remove(os.path.join(self.directory, name))
+				self.size -= size
+			except OSError:
+				pass
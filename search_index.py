@@ -0,0 +1,226 @@
+
+# Copyright (C) 2011 by Oliver Ainsworth
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+from array import array
+
+class SearchIndex(object):
+	
+	# Weight given to a query term for each field of the entry it
+	# appears in. A term appearing in several fields gets the sum.
+	field_weights = {
+					"tags": 0.1,
+					"category": 0.15,
+					"description": 0.25,
+					"title": 0.35,
+					}
+	
+	# Each field is given a bit so the fields a term appears in can be
+	# stored in the low bits of each posting. mask_weights maps each of
+	# the possible masks to the summed weight of its fields.
+	field_bits = {
+				"tags": 1,
+				"category": 2,
+				"description": 4,
+				"title": 8,
+				}
+	mask_weights = [sum([weight for field, weight in field_weights.iteritems()
+							if mask & field_bits[field]])
+						for mask in xrange(16)]
+	
+	# Once more than this fraction of the documents in the postings
+	# have been removed, they're compacted before being persisted.
+	max_dead_fraction = 0.25
+	
+	def __init__(self, state=None):
+		"""
+			An inverted index mapping each term to the videos it appears
+			in, along with which fields of each video it appears in.
+			
+			Videos are numbered by the order they were added in. Each
+			term's postings are an array of integers, one per video it
+			appears in, holding the video's number shifted left by four
+			bits with the field mask in the low four bits. Removing a
+			video only forgets its number; its postings are skipped until
+			they're compacted away.
+			
+				`state` - as previously returned by the `state` property.
+						If not set, an empty index is created.
+		"""
+		
+		if state:
+			self.vids, self.postings = state
+			self.vids = list(self.vids)
+			self.postings = dict(self.postings)
+		else:
+			self.vids = []
+			self.postings = {}
+			
+		self.docnos = dict([(vid, docno) for docno, vid 
+								in enumerate(self.vids) if vid is not None])
+	
+	@classmethod
+	def split_query(cls, query):
+		"""
+			Returns the set of search terms in the string `query`.
+		"""
+		
+		return set([chunk.lower().strip() 
+						for chunk in query.split(" ") if len(chunk) > 2])
+	
+	@classmethod
+	def entry_masks(cls, entry):
+		"""
+			Returns a dictionary mapping each term found in `entry` to
+			the mask of the fields it was found in.
+		"""
+		
+		fields = {
+				"tags": set([tag.lower() for tag in entry.tags]),
+				"category": set([entry.category.lower()]),
+				"description": set([chunk.lower() 
+									for chunk in entry.description.split(" ")]),
+				"title": set([chunk.lower() 
+									for chunk in entry.title.split(" ")]),
+				}
+		
+		masks = {}
+		for field, terms in fields.iteritems():
+			for term in terms:
+				masks[term] = masks.get(term, 0) | cls.field_bits[field]
+				
+		return masks
+	
+	def _posting(self, term):
+		"""
+			Returns the postings array for `term`, decoding it from its
+			persisted form if need be.
+		"""
+		
+		posting = self.postings[term]
+		if posting.__class__ is str:
+			posting = array("I")
+			posting.fromstring(self.postings[term])
+			self.postings[term] = posting
+			
+		return posting
+	
+	def add(self, vid, entry):
+		"""
+			Adds the VideoIndexEntry `entry` to the index under the
+			video ID `vid`, replacing any terms previously indexed
+			for it.
+		"""
+		
+		self.remove(vid)
+		
+		docno = len(self.vids)
+		self.vids.append(vid)
+		self.docnos[vid] = docno
+		
+		postings = self.postings
+		for term, mask in self.__class__.entry_masks(entry).iteritems():
+			posting = postings.get(term)
+			if posting is None:
+				posting = postings[term] = array("I")
+			elif posting.__class__ is str:
+				posting = self._posting(term)
+			posting.append(docno << 4 | mask)
+	
+	def remove(self, vid):
+		"""
+			Removes the video ID `vid` from the index. Does nothing if
+			`vid` isn't in the index.
+		"""
+		
+		docno = self.docnos.pop(vid, None)
+		if docno is not None:
+			self.vids[docno] = None
+	
+	def weigh(self, query):
+		"""
+			Returns a dictionary mapping video IDs to their total weight
+			for the string `query`. Videos with no matching terms, i.e.
+			a weight of zero, are not included.
+		"""
+		
+		mask_weights = self.__class__.mask_weights
+		
+		weights = {}
+		for term in self.__class__.split_query(query):
+			if term not in self.postings:
+				continue
+			
+			for posting in self._posting(term):
+				docno = posting >> 4
+				weights[docno] = (weights.get(docno, 0) + 
+									mask_weights[posting & 15])
+		
+		return dict([(self.vids[docno], weight) 
+						for docno, weight in weights.iteritems()
+							if self.vids[docno] is not None])
+	
+	def compact(self):
+		"""
+			Renumbers the videos in the index to drop the postings of
+			those which have been removed.
+		"""
+		
+		renumber = {}
+		vids = []
+		for docno, vid in enumerate(self.vids):
+			if vid is not None:
+				renumber[docno] = len(vids)
+				vids.append(vid)
+		
+		postings = {}
+		for term in self.postings:
+			posting = array("I", [renumber[docno] << 4 | (value & 15)
+								for value in self._posting(term)
+									for docno in (value >> 4,)
+										if docno in renumber])
+			if posting:
+				postings[term] = posting
+		
+		self.vids = vids
+		self.postings = postings
+		self.docnos = dict([(vid, docno) for docno, vid in enumerate(vids)])
+	
+	def __contains__(self, vid):
+		return vid in self.docnos
+	
+	def _get_state(self):
+		
+		dead = len(self.vids) - len(self.docnos)
+		if dead > len(self.vids) * self.__class__.max_dead_fraction:
+			self.compact()
+		
+		# Arrays pickle as lists of numbers, which is slow, so they're
+		# persisted as strings of their raw contents instead.
+		postings = {}
+		for term, posting in self.postings.iteritems():
+			if posting.__class__ is str:
+				postings[term] = posting
+			else:
+				postings[term] = posting.tostring()
+				
+		return (self.vids, postings)
+	
+	state = property(_get_state)
@@ -0,0 +1,374 @@
+
+# Copyright (C) 2011 by Oliver Ainsworth
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import os
+import json
+import sqlite3
+
+from video_index import VideoIndex, VideoIndexEntry, state_path
+from search_index import SearchIndex
+from exclusion_rule import Untranslatable
+
+class SQLiteVideoIndexEntry(VideoIndexEntry):
+	
+	__slots__ = ("index",)
+	
+	def __init__(self, index, directory, meta):
+		"""
+			A VideoIndexEntry of a SQLiteVideoIndex `index`. Its
+			description is loaded from the database when needed.
+		"""
+		
+		VideoIndexEntry.__init__(self, directory, meta)
+		self.index = index
+	
+	def _load_description(self):
+		
+		row = self.index.connection.execute(
+				"SELECT description FROM videos WHERE id = ?", 
+				(self.id,)).fetchone()
+		
+		return str(row[0]) if row else ""
+
+class SQLiteVideoIndex(VideoIndex):
+	
+	# Meta is stored in a single SQLite database, one of the state files
+	# of the index, instead of a meta file per entry. Entries still
+	# get a directory each, to house their media file.
+	database_name = "index.sqlite"
+	
+	schema = """
+		CREATE TABLE IF NOT EXISTS videos (
+			id TEXT PRIMARY KEY,
+			uri TEXT NOT NULL,
+			title TEXT NOT NULL,
+			description TEXT NOT NULL,
+			category TEXT NOT NULL,
+			tags TEXT NOT NULL,
+			date_published REAL NOT NULL,
+			media_size INTEGER,
+			media_sha1 TEXT
+		);
+		CREATE INDEX IF NOT EXISTS videos_date_published 
+			ON videos (date_published);
+		CREATE INDEX IF NOT EXISTS videos_category ON videos (category);
+		CREATE VIRTUAL TABLE IF NOT EXISTS videos_fts USING fts5 (
+			id UNINDEXED, title, description, category, tags
+		);
+		CREATE TABLE IF NOT EXISTS state (
+			key TEXT PRIMARY KEY,
+			value TEXT
+		);
+		"""
+	
+	# Columns making up an entry, less the description which is only
+	# loaded when needed. Tags are stored as a JSON list.
+	columns = ("id", "uri", "title", "category", "tags", "date_published",
+				"media_size", "media_sha1")
+	
+	# Columns added since the table was first created, and their types,
+	# which databases created before then need adding.
+	added_columns = (
+				("media_size", "INTEGER"),
+				("media_sha1", "TEXT"),
+				)
+	
+	def __init__(self, directory, media_store=None):
+		"""
+			Represents a local video index stored in a SQLite database.
+			
+			If the existing directory layout hasn't been migrated into
+			the database yet, e.g. it's only just been created, its
+			entries are. Their meta files and media are left where they
+			are.
+			
+			Requires SQLite to have been built with FTS5; if it hasn't,
+			sqlite3.OperationalError is raised.
+		"""
+		
+		VideoIndex.__init__(self, directory, media_store)
+		
+		self.database = state_path(self.directory, 
+										self.__class__.database_name)
+		
+		# Databases used to be kept at the root of the index, along with
+		# the journal of any transaction a crash interrupted.
+		legacy_database = os.path.join(self.directory, 
+										self.__class__.database_name)
+		if (os.path.isfile(legacy_database) and 
+				not os.path.exists(self.database)):
+			for suffix in ("-journal", ""):
+				if os.path.exists(legacy_database + suffix):
+					os.rename(legacy_database + suffix, self.database + suffix)
+		
+		created = not os.path.exists(self.database)
+		
+		self.connection = sqlite3.connect(self.database)
+		self.connection.text_factory = str
+		
+		try:
+			with self.connection:
+				self.connection.executescript(self.__class__.schema)
+				
+				existing = set([row[1] for row in self.connection.execute(
+										"PRAGMA table_info(videos)")])
+				for column, type_ in self.__class__.added_columns:
+					if column not in existing:
+						self.connection.execute(
+							"ALTER TABLE videos ADD COLUMN {0} {1}".format(
+														column, type_))
+		except sqlite3.OperationalError:
+			self.connection.close()
+			if created:
+				os.remove(self.database)
+			raise
+		
+		if not self._migrated():
+			self.migrate()
+	
+	def _migrated(self):
+		"""
+			Returns whether the migration has finished. Databases from
+			before that was recorded were migrated if they have any
+			entries at all.
+		"""
+		
+		if self.connection.execute(
+				"SELECT 1 FROM state WHERE key = 'migrated'").fetchone():
+			return True
+		
+		return bool(self.connection.execute(
+				"SELECT 1 FROM videos LIMIT 1").fetchone())
+	
+	def migrate(self):
+		"""
+			Imports the meta file of every entry directory in the index
+			into the database, replacing any existing rows. Entries whose
+			meta files are corrupted or incomplete are skipped.
+			
+			It's all one transaction, finished off by recording that the
+			migration is done, so if it's interrupted it's started over
+			the next time the index is opened.
+		"""
+		
+		print "Migrating video index to '{0}' ...".format(self.database)
+		
+		count = 0
+		with self.connection:
+			for vid in os.listdir(self.directory):
+				
+				meta_file = os.path.join(self.directory, vid, "meta")
+				if not os.path.isfile(meta_file):
+					continue
+				
+				try:
+					with open(meta_file, "r") as file_:
+						meta = json.loads(file_.read())
+				except ValueError:
+					meta = None
+				
+				if not isinstance(meta, dict):
+					print "Error: Corrupted entry for {0}".format(vid)
+					continue
+				
+				if [name for name in VideoIndexEntry.required_keys 
+						if name not in meta]:
+					print "Error: Incomplete meta file for {0}".format(vid)
+					continue
+				
+				self._write(VideoIndexEntry(
+								os.path.join(self.directory, vid), meta))
+				count += 1
+			
+			self.connection.execute("INSERT OR REPLACE INTO state (key, value)"
+										" VALUES ('migrated', '1')")
+				
+		print "Migrated {0} entries.".format(count)
+	
+	def _write(self, entry):
+		"""
+			Inserts or replaces the row for `entry`. Must be called
+			within a transaction.
+		"""
+		
+		self.connection.execute(
+			"INSERT OR REPLACE INTO videos (id, uri, title, description,"
+			" category, tags, date_published, media_size, media_sha1)"
+			" VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+			(entry.id, entry.uri, entry.title, entry.description,
+				entry.category, json.dumps(list(entry.tags)), 
+				entry.date_published, entry.expected_media_size,
+				entry.media_sha1))
+		self.connection.execute(
+			"DELETE FROM videos_fts WHERE id = ?", (entry.id,))
+		self.connection.execute(
+			"INSERT INTO videos_fts (id, title, description, category, tags)"
+			" VALUES (?, ?, ?, ?, ?)",
+			(entry.id, entry.title, entry.description, entry.category, 
+				" ".join(entry.tags)))
+	
+	def _entry(self, row):
+		"""
+			Creates an SQLiteVideoIndexEntry from a row of `columns`.
+		"""
+		
+		meta = dict(zip(self.__class__.columns, row))
+		meta["tags"] = json.loads(meta["tags"])
+		
+		return SQLiteVideoIndexEntry(self, 
+								os.path.join(self.directory, meta["id"]), meta)
+	
+	def _select(self, vid):
+		
+		row = self.connection.execute(
+				"SELECT {0} FROM videos WHERE id = ?".format(
+							", ".join(self.__class__.columns)),
+				(vid,)).fetchone()
+				
+		return self._entry(row) if row else None
+	
+	def add(self, meta, rule=None):
+		"""
+			As VideoIndex.add(), except the meta is written to the
+			database. The entry's directory is still created so it's
+			ready for the media file.
+		"""
+		
+		dir_name = os.path.join(self.directory, meta["id"])
+		entry = SQLiteVideoIndexEntry(self, dir_name, meta)
+		existing = self.videos.get(entry.id) or self._select(entry.id)
+		
+		if rule is not None and rule.evaluate(entry):
+			if existing is not None:
+				self.videos[entry.id] = existing
+				self.delete(entry.id)
+			elif os.path.exists(dir_name):
+				entry.delete()
+			return None
+		
+		if not os.path.exists(dir_name):
+			os.mkdir(dir_name)
+		
+		if existing is not None:
+			entry = SQLiteVideoIndexEntry(self, dir_name,
+									self._merge_local_meta(existing, meta))
+			
+		if existing is None or existing.meta != entry.meta:
+			if self._batch is None:
+				with self.connection:
+					self._write(entry)
+			else:
+				self._write(entry)
+		else:
+			entry = existing
+		
+		self.videos[entry.id] = entry
+		
+		return entry
+	
+	def _commit_batch(self, batch):
+		
+		# Everything written since the batch began is one transaction.
+		self.connection.commit()
+	
+	def _save_entry(self, entry):
+		
+		with self.connection:
+			self._write(entry)
+	
+	def delete(self, vid):
+		
+		# The entry may not have been loaded, e.g. it was found by
+		# matching() after being added by something else.
+		entry = self.videos.pop(vid, None) or self._select(vid)
+		
+		with self.connection:
+			self.connection.execute("DELETE FROM videos WHERE id = ?", (vid,))
+			self.connection.execute(
+				"DELETE FROM videos_fts WHERE id = ?", (vid,))
+		
+		if entry is not None:
+			self._delete_files(entry)
+	
+	def matching(self, rule):
+		"""
+			As VideoIndex.matching(), except that if `rule` can be 
+			translated to SQL, the matching entries are found by the
+			database, using its indexes, rather than by evaluating the
+			rule against every entry.
+		"""
+		
+		try:
+			condition, params = rule.sql_condition()
+		except Untranslatable:
+			return VideoIndex.matching(self, rule)
+		
+		return [vid for (vid,) in self.connection.execute(
+								"SELECT id FROM videos WHERE " + condition,
+								params)]
+	
+	def sync(self, vids=None):
+		"""
+			Loads entries from the database. If `vids` is set, only
+			those with the given IDs are loaded, and any which aren't in
+			the database are dropped from the index.
+		"""
+		
+		if vids is not None:
+			for vid in vids:
+				entry = self._select(str(vid))
+				if entry is None:
+					self.videos.pop(str(vid), None)
+				else:
+					self.videos[entry.id] = entry
+			return
+		
+		print "Syncronising video index ..."
+		
+		videos = {}
+		for row in self.connection.execute("SELECT {0} FROM videos".format(
+									", ".join(self.__class__.columns))):
+			entry = self._entry(row)
+			videos[entry.id] = entry
+		
+		# Replaced wholesale, so entries which have since been deleted
+		# are dropped.
+		self.videos = videos
+	
+	def search(self, query, threshold=0.25, limit=None):
+		"""
+			As VideoIndex.search(), using the full-text index of the
+			database. Terms are matched against FTS5 tokens of each
+			field rather than space separated chunks, so punctuation
+			doesn't get in the way of a match.
+		"""
+		
+		weights = {}
+		for term in SearchIndex.split_query(query):
+			
+			phrase = "\"{0}\"".format(term.replace("\"", "\"\""))
+			for field, weight in SearchIndex.field_weights.iteritems():
+				for (vid,) in self.connection.execute(
+						"SELECT id FROM videos_fts WHERE videos_fts MATCH ?",
+						("{0} : {1}".format(field, phrase),)):
+					weights[vid] = weights.get(vid, 0) + weight
+		
+		return self._rank(weights, threshold, limit)
@@ -26,92 +26,367 @@ import optparse
 import json
 import getpass
 import time
-from time import sleep
+import atexit
+import cProfile
 
-import gdata.youtube.service
-import gdata.youtube
-# API Reference: http://gdata-python-client.googlecode.com/hg/pydocs/gdata.html
+# gdata, and the modules which depend on it, are only imported by the
+# actions which talk to YouTube. Importing it takes longer than a 'play'
+# or 'search' otherwise would in total.
 
-from video_index import VideoIndex
-from yt_client import YouTubeClient
+from video_index import VideoIndex, state_path
 from exclusion_rule import ExclusionRule
+from worker_pool import imap_unordered, istream_unordered, FINISHED
+from feed_marks import FeedMarks
+from download_queue import DownloadQueue
+from media_store import MediaStore
+from timings import Timings, RequestStats
+from auth_cache import AuthCache
+from response_cache import ResponseCache
 
-def login(user=None, password=None):
+# Where the time goes in a run, and the requests made to YouTube. Only
+# reported with --timings or --profile.
+timings = Timings()
+request_stats = RequestStats()
+
+def load_rule(expression):
+	
+	try:
+		return ExclusionRule(expression)
+	except (SyntaxError, ValueError) as exce:
+		print "Error: Invalid exclusion rule '{0}'! {1}".format(expression, exce)
+		exit()
+
+class LoginError(Exception):
+	"""
+		Raised by the client login() returns when its session expires
+		and it can't log in again.
+	"""
+
+def login(user=None, password=None, rate=5, auth_cache=None, 
+												response_cache=None):
+	
+	# API Reference: http://gdata-python-client.googlecode.com/hg/pydocs/gdata.html
+	import gdata.service
+	from yt_client import YouTubeClient
+	
+	# The password is only asked for if it's needed; if it's needed a
+	# second time, because the session expired part way through, it's
+	# not asked for again. If logging in again fails, it's not tried
+	# again by every other thread whose session expired too.
+	credentials = {"password": password, "failed": None}
+	
+	def ask_password():
+		
+		# Shells which have a command history featuer may save previous commands to a
+		# plain-text file. This means, any passwords used via the -p or --password
+		# switch/flag/whatever will be exposed.
+		if credentials["password"] is None:
+			try:
+				credentials["password"] = getpass.getpass("YouTube password: ")
+			except EOFError:
+				credentials["password"] = ""
+		
+		if not user or not credentials["password"]:
+			raise LoginError("Attempt to login failed due to no user or"
+								" password being provided!")
+	
+	def authenticate(client):
+		
+		with timings.phase("login"):
+			client.ClientLogin(user, credentials["password"])
+		
+		if auth_cache is not None:
+			auth_cache.store(user, client.GetClientLoginToken())
+			try:
+				auth_cache.save()
+			except (IOError, OSError) as exce:
+				print "Warning: Failed to save the login session! {0}".format(exce)
 	
-	# Shells which have a command history featuer may save previous commands to a
-	# plain-text file. This means, any passwords used via the -p or --password
-	# switch/flag/whatever will be exposed.
-	if password is None:
-		password = getpass.getpass("YouTube password: ")
+	def reauthenticate(client):
+		
+		# Called from whichever thread's request found the session had
+		# expired, so failures are raised, as LoginError, to be dealt
+		# with by the action, rather than exiting.
+		if credentials["failed"] is not None:
+			raise credentials["failed"]
+		
+		print "Login session expired, logging in again ..."
+		if auth_cache is not None:
+			auth_cache.forget(user)
+		
+		try:
+			ask_password()
+			authenticate(client)
+		except gdata.service.BadAuthentication:
+			credentials["failed"] = LoginError("Incorrect username or password!")
+			raise credentials["failed"]
+		except LoginError as exce:
+			credentials["failed"] = exce
+			raise
 	
-	if not user or not password:
-		print "Error: Attempt to login failed due to no user or password being provided!"
+	client = YouTubeClient(user, None, rate=rate, stats=request_stats,
+							reauthenticate=reauthenticate,
+							response_cache=response_cache)
+	
+	token = auth_cache.token(user) if auth_cache is not None and user else None
+	if token is not None:
+		print "Logging in ... Okay! (Saved session)"
+		client.SetClientLoginToken(token)
+		return client
+	
+	try:
+		ask_password()
+	except LoginError as exce:
+		print "Error: {0}".format(exce)
 		exit()
 	
 	print "Logging in ...",
 	try:
-		client = YouTubeClient.Login(user, password)
+		authenticate(client)
 		print "Okay!"
 		return client
 	except gdata.service.BadAuthentication:
 		print "Error: Incorrect username or password!"
 		exit()
 
+def update_index(client, videx, sub_feed, marks, rule=None, limit=25, pages=4,
+					start_index=1, threads=8):
+	"""
+		Adds the new videos of each channel in the subscription feed
+		`sub_feed` to the VideoIndex `videx`, as 'update' does, fetching
+		`threads` channel feeds at a time through the YouTubeClient
+		`client`. Returns the number of new videos added; those
+		excluded by `rule` aren't counted.
+		
+		`marks` is the FeedMarks of the index, which is only used, and
+		saved, if `start_index` is 1. Videos which match the
+		ExclusionRule `rule` aren't added. `limit`, `pages` and
+		`start_index` are as the options of the same names.
+	"""
+	
+	import gdata.service
+	
+	# Feeds list the newest videos first, so once a video no newer
+	# than the newest seen last time is reached, the rest of the feed
+	# is already in the index. Not so when backdating, of course.
+	use_marks = start_index == 1
+	
+	feeds = []
+	for sub_entry in sub_feed.entry:
+		for link in sub_entry.feed_link:
+			
+			uri = "".join([link.href, "?", 
+						"&".join(["max-results={0}".format(limit),
+								"start-index={0}".format(start_index)])])
+			feeds.append((link.href, uri))
+	
+	def fetch_feed(feed):
+		"""
+			Yields a tuple of (video ID, meta) for each new entry of
+			`feed`, paging through it as needed. If the entry can't
+			be turned into a meta dict, the meta is None.
+		"""
+		
+		href, uri = feed
+		latest = marks.latest(href)
+		
+		if use_marks:
+			entries = client.IterVideoFeed(uri, pages,
+										modified_since=marks.checked(href))
+		else:
+			entries = client.IterVideoFeed(uri, pages)
+		
+		with timings.phase("feed {0}".format(href)):
+			for entry in entries:
+				try:
+					with timings.phase("meta parse"):
+						meta = client.GetVideoMeta(entry=entry)
+				except AttributeError:
+					yield entry.id.text.split("/")[-1], None
+					continue
+			
+				if use_marks and meta["date_published"] <= latest:
+					break
+				
+				yield meta["id"], meta
+	
+	# The feeds are fetched concurrently, but their entries are added
+	# to the index from this thread, one at a time, as they arrive. A
+	# feed's mark is only moved once all of it has been seen, so an
+	# error part way through doesn't leave a gap in the index. Meta
+	# files are written in one batch, flushed to disk at the end,
+	# rather than one at a time.
+	added = 0
+	with videx.batch():
+		seen = {}
+		fetched_at = time.time()
+		for (href, uri), value, exce in istream_unordered(fetch_feed,
+													feeds, threads):
+		
+			if exce is None:
+			
+				if value is FINISHED:
+					count, excluded, newest = seen.pop(href, (0, 0, None))
+					if excluded:
+						print "Feed: {0} ({1} new, {2} excluded)".format(href, 
+														count, excluded)
+					else:
+						print "Feed: {0} ({1} new)".format(href, count)
+					if use_marks:
+						marks.mark(href, fetched_at, newest)
+					continue
+			
+				vid, meta = value
+				if meta is None:
+					print "Error: Can't fetch video data for {0}".format(vid)
+					continue
+			
+				with timings.phase("index add"):
+					entry = videx.add(meta, rule)
+				
+				# Excluded videos still count towards the feed's mark, so
+				# they aren't fetched again.
+				count, excluded, newest = seen.get(href, (0, 0, None))
+				if entry is None:
+					excluded += 1
+				else:
+					count += 1
+					added += 1
+				seen[href] = (count, excluded, 
+								max(newest, meta["date_published"]))
+					
+			elif isinstance(exce, gdata.service.RequestError):
+				# The failed request was thought to be caused by being
+				# too excessive with the number of requests. The client
+				# now throttles and retries 403s itself, so by this
+				# point it's most likely a genuine error.
+			
+					# ... actually it appears this may not be the
+					# case. In the test environment, 403 is only
+					# returned when accessing the 'totalhalibut'
+					# feed. Will investigate further. 
+			
+						# Going to handle it as a regular unexpected
+						# response, instead of a special case. At 
+						# least until more is known.
+					
+					# The RequestError is raised when accessing the
+					# video's 'meta' data via YouTubeClient.GetVideoMeta.
+					# So it's per-video request, not per-feed it appears.
+				print "Error: Unexpected response to feed request for" \
+										" {0}! {1}".format(href, exce)
+			elif isinstance(exce, LoginError):
+				# Every other feed would fail the same way. Those already
+				# fetched are still added, and their marks saved.
+				print "Error: Can't log in again! {0}".format(exce)
+				break
+			else:
+				raise exce
+		
+		# The batch of meta files is written when the block exits.
+		timings.start("disk writes")
+	timings.stop("disk writes")
+	
+	if use_marks:
+		try:
+			marks.save()
+		except (IOError, OSError) as exce:
+			print "Warning: Failed to save feed marks! {0}".format(exce)
+	
+	return added
+
 CONFIG_DIR_PATH = os.path.join(
 					os.getenv("XDG_CONFIG_HOME", os.path.join(os.path.expanduser("~"), ".config"))
 					, "pysubbox")
 CONFIG_FILE_PATH = os.path.join(CONFIG_DIR_PATH, "config.json")
+AUTH_FILE_PATH = os.path.join(CONFIG_DIR_PATH, "auth.json")
+
+RESPONSE_CACHE_PATH = os.path.join(
+					os.getenv("XDG_CACHE_HOME", os.path.join(os.path.expanduser("~"), ".cache"))
+					, "pysubbox", "responses")
 
 DEFAULT_CONFIG = {
 				"username": "",
 							
 				"cmd": {
 						"play": "mplayer {media_file}",
-						"download": "clive -f {format} --output-file='{media_file}' {uri}",
+						"download": "clive --continue -f {format} --output-file='{media_file}' {uri}",
 						},
 						
 				"resolution": "best",
 				
 				"search_limit": 15, # 0 = all
 				"feed_limit": 25, # 0 - 50
+				"feed_pages": 4, # 0 = all
 				
 				"threshold": 0.33, # 0 - 1
 				
+				"threads": 8,
+				"max_downloads": 2,
+				"download_retries": 2,
+				"request_rate": 5, # per second
+				
 				"index_dir": os.path.join(os.path.expanduser("~"),
 											"Videos", "Subscriptions"),
 											
 				"rule": "entry.date_published < now() - days(3)",
+				
+				"backend": "directory", # or "sqlite"
+				"dedupe_media": False,
+				"cache_login": True,
+				"response_cache_ttl": 900, # seconds
+				"response_cache_size": 100, # MB, 0 = no cache
+				"watch_interval": 5, # seconds, 0 = don't watch
 				}
 
-if not os.path.isfile(CONFIG_FILE_PATH):
-	print "Configuration file missing! Creating it '{0}' ...".format(CONFIG_FILE_PATH)
+def load_config():
+	"""
+		Returns the configuration from CONFIG_FILE_PATH, with defaults
+		filled in for any missing keys. If the file doesn't exist, it's
+		created with the default configuration.
+	"""
 	
-	if not os.path.isdir(CONFIG_DIR_PATH):
-		os.mkdir(CONFIG_DIR_PATH)
+	if not os.path.isfile(CONFIG_FILE_PATH):
+		print "Configuration file missing! Creating it '{0}' ...".format(CONFIG_FILE_PATH)
 		
-	with open(CONFIG_FILE_PATH, "w") as config_file:
-		json.dump(DEFAULT_CONFIG, config_file, sort_keys=True, indent=4)
-
-with open(CONFIG_FILE_PATH, "r") as config_file:
+		if not os.path.isdir(CONFIG_DIR_PATH):
+			os.mkdir(CONFIG_DIR_PATH)
+			
+		with open(CONFIG_FILE_PATH, "w") as config_file:
+			json.dump(DEFAULT_CONFIG, config_file, sort_keys=True, indent=4)
+	
+	with open(CONFIG_FILE_PATH, "r") as config_file:
+		
+		config = json.load(config_file)
+		for key in DEFAULT_CONFIG:
+			if key not in config:
+				config[key] = DEFAULT_CONFIG[key]
 	
-	config = json.load(config_file)
-	for key in DEFAULT_CONFIG:
-		if key not in config:
-			config[key] = DEFAULT_CONFIG[key]
+	return config
 
-if __name__ == '__main__':
+def main():
+	
+	with timings.phase("config load"):
+		config = load_config()
 	
-	option_parser = optparse.OptionParser(usage="python %prog (update|search|(download|play|repair videoID, ...)) [options]")
+	option_parser = optparse.OptionParser(usage="python %prog (update|search|clean|serve|(download|play|repair videoID, ...)) [options]")
 	option_parser.add_option("-u", "--username", action="store", type="string", dest="username", default=config["username"], help="username/email you use to log into YouTube")
 	option_parser.add_option("-p", "--password", action="store", type="string", dest="password", help="password you use to log into YouTube")
 	option_parser.add_option("-q", "--query", action="store", type="string", dest="search_query", help="query used to search the video index")
 	option_parser.add_option("--limit", action="store", type="int", dest="limit", default=-1, help="if 'search', truncates the number of results, if 'update' limits the number of videos to fetch from the feed")
 	option_parser.add_option("--threshold", action="store", type="float", dest="threshold", default=config["threshold"], help="set the threshold, as a fraction in the range 0 <= x <= 1, for search results; higher = only the very best matches are printed")
 	option_parser.add_option("--index-dir", action="store", type="string", dest="index_dir", default=config["index_dir"], help="the path to the directory which should be indexed; defaults to ~/Videos/YouTube")
+	option_parser.add_option("--pages", action="store", type="int", dest="pages", default=config["feed_pages"], help="when updating, the maximum number of pages to fetch from each feed; 0 for all of them")
 	option_parser.add_option("--start-index", action="store", type="int", dest="start_index", default=1, help="when updating, where should the feed index start from; greater = older videos")
 	option_parser.add_option("-r", "--resolution", action="store", type="string", dest="resolution", default=config["resolution"], help="when downloading, determines the format to be requested, based on closest matched resolution; clive presets also accepted")
 	option_parser.add_option("-c", "--cmd", action="store", type="string", dest="cmd", default=None, help="command to be used when downloading/playing media, see the README for details")
 	option_parser.add_option("--rule", action="store", type="string", dest="rule", default=config["rule"], help="a Python expression used to describe 'rules' that exclude certain enteries from the the index")
+	option_parser.add_option("--threads", action="store", type="int", dest="threads", default=config["threads"], help="the maximum number of feeds to fetch concurrently when updating, or entries when repairing")
+	option_parser.add_option("--max-downloads", action="store", type="int", dest="max_downloads", default=config["max_downloads"], help="the maximum number of videos to download at the same time")
+	option_parser.add_option("--all", action="store_true", dest="all", default=False, help="when repairing, also repair every entry in the index whose meta file is missing, corrupted or incomplete")
+	option_parser.add_option("--partial", action="store_true", dest="partial", default=False, help="when downloading, also resume any partially downloaded videos in the index")
+	option_parser.add_option("--timings", action="store_true", dest="timings", default=False, help="when finished, report how long was spent in each phase and the requests made to YouTube")
+	option_parser.add_option("--profile", action="store", type="string", dest="profile", default=None, help="profile the run, writing the pstats to the given file; implies --timings")
 	option_parser.add_option("-f", "--force", action="store_true", dest="force", default=False, help="when set certain confirmation requests will be skipped")
 	
 	try:
@@ -124,101 +399,143 @@ if __name__ == '__main__':
 	
 	if options.limit == -1:
 		
-		if action == "search":
+		if action in ("search", "download"):
 			options.limit = config["search_limit"]
 		elif action == "update":
 			options.limit = config["feed_limit"]
 	
+	if options.timings or options.profile:
+		
+		profiler = None
+		if options.profile:
+			# Only the main thread is profiled; time spent in the threads
+			# fetching feeds shows in the timings instead.
+			profiler = cProfile.Profile()
+			profiler.enable()
+		
+		# Registered, rather than called at the end, so it happens
+		# however the action exits.
+		def report():
+			
+			if profiler is not None:
+				profiler.disable()
+				try:
+					profiler.dump_stats(options.profile)
+				except IOError as exce:
+					print >> sys.stderr, "Error: Can't write the profile! {0}".format(exce)
+			
+			print >> sys.stderr, "\n".join(timings.report())
+			if request_stats.requests:
+				print >> sys.stderr, "\n".join(request_stats.report())
+			
+		atexit.register(report)
+	
+	def connect():
+		
+		auth_cache = None
+		if config["cache_login"]:
+			auth_cache = AuthCache(AUTH_FILE_PATH)
+		
+		response_cache = None
+		if config["response_cache_size"] > 0:
+			response_cache = ResponseCache(RESPONSE_CACHE_PATH,
+								config["response_cache_ttl"],
+								config["response_cache_size"] * 1024 * 1024)
+		
+		return login(options.username, options.password, 
+						config["request_rate"], auth_cache, response_cache)
+	
 	if options.password:
 		print "Warning: Use of the -p or --password is discouraged as a potential" \
 				" security vunerability!"
 	
-	videx = VideoIndex(options.index_dir)
-
-	if action == "update":
+	# Actions which only need to look things up in the index, or make
+	# small changes to it, are handed to the 'serve' daemon if there's
+	# one running, rather than loading the index themselves. There's
+	# no point importing what's needed to talk to it if there isn't.
+	socket_path = state_path(options.index_dir, "socket")
+	
+	def connect_server():
+		
+		if not os.path.exists(socket_path):
+			return None
+		
+		from index_server import RemoteIndex
+		return RemoteIndex.connect(socket_path)
+	
+	def notify_server(vids=None):
 		
-		ex_rule = ExclusionRule(options.rule)
-		client = login(options.username, options.password)
+		server = connect_server()
+		if server is not None:
+			print "Letting the server know about the changes ..."
+			server.resync(vids)
+	
+	videx = None
+	if action in ("search", "play", "download", "clean"):
+		videx = connect_server()
+	
+	def open_index():
 		
-		feed_fetch_attempts = 3
-		while feed_fetch_attempts > 0:
+		media_store = None
+		if config["dedupe_media"]:
+			media_store = MediaStore(os.path.join(options.index_dir, ".media"))
+		
+		if config["backend"] == "sqlite":
 			
-			print "Fetching subscription feed ...",
-			try:
-				sub_feed = client.GetYouTubeSubscriptionFeed()
-				if isinstance(sub_feed, gdata.youtube.YouTubeSubscriptionFeed):
-					print "Okay!"
-					feed_fetch_attempts = 0
-					continue
-			except gdata.service.RequestError:
-				pass
+			import sqlite3
+			from sqlite_video_index import SQLiteVideoIndex
 			
-			feed_fetch_attempts -= 1
-			if feed_fetch_attempts == 0:
-				print "Error: Can't seem to get ahold of the feed. Try again later."
+			try:
+				return SQLiteVideoIndex(options.index_dir, media_store)
+			except sqlite3.OperationalError as exce:
+				print "Error: Can't open the SQLite video index! {0}".format(exce)
 				exit()
-			else:
-				print "Error: Failed! Trying again in 10 seconds."
-				sleep(10)
+		else:
+			return VideoIndex(options.index_dir, media_store)
+	
+	if videx is None:
+		videx = open_index()
+
+	if action == "update":
 		
-		for sub_entry in sub_feed.entry:
-			for link in sub_entry.feed_link:
-				
-				uri = "".join([link.href, "?", 
-							"&".join(["max-results={0}".format(options.limit),
-									"start-index={0}".format(options.start_index)])])
-				
-				try:
-					feed = client.GetYouTubeVideoFeed(uri)
-					print "Feed: {0}".format(link.href)
-					
-					for entry in feed.entry:
-						try:
-							videx.add(client.GetVideoMeta(entry=entry))
-						except AttributeError:
-							print "Error: Can't fetch video data for {0}".format(
-														entry.id.text.split("/")[-1])
-						
-				except gdata.service.RequestError as exce:
-					# FIXME: The failed request is caused by being too
-					# excessive with the number of requests. Find what 
-					# the limit is and throttle accordingly.
-					
-						# ... actually it appears this may not be the
-						# case. In the test environment, 403 is only
-						# returned when accessing the 'totalhalibut'
-						# feed. Will investigate further. 
-					
-							# Going to handle it as a regular unexpected
-							# response, instead of a special case. At 
-							# least until more is known.
-							
-						# The RequestError is raised when accessing the
-						# video's 'meta' data via YouTubeClient.GetVideoMeta.
-						# So it's per-video request, not per-feed it appears.
-					print "Error: Unexpected response to feed request!" \
-													" {0}".format(exce)
-				
+		import gdata.service
 		
-		# Now to filter out those that match exclusion rule. This could be done
-		# as each entry is beign created but it's messy with the current API.
-		# This is totally fine as long as videx.sync() isn't called, otherwise
-		# you'd get the same functionality as 'clean'; ALL enteries matching
-		# the rule would get deleted, not just the NEW enteries that match.
-		for vid, entry in videx:
-			if ex_rule.evaluate(entry):
-				entry.delete()
+		ex_rule = load_rule(options.rule)
+		client = connect()
+		
+		# Transient failures are retried by the client itself.
+		print "Fetching subscription feed ...",
+		try:
+			with timings.phase("subscription feed"):
+				sub_feed = client.GetYouTubeSubscriptionFeed()
+			print "Okay!"
+		except gdata.service.RequestError:
+			print "Error: Can't seem to get ahold of the feed. Try again later."
+			exit()
+		except LoginError as exce:
+			print "Error: Can't log in again! {0}".format(exce)
+			exit()
+		
+		marks = FeedMarks(state_path(options.index_dir, "feeds"))
+		update_index(client, videx, sub_feed, marks, ex_rule, options.limit,
+						options.pages, options.start_index, options.threads)
+		
+		notify_server()
 		
 	elif action == "search":
 		
 		if options.search_query or options.search_query == "":
 			
 			print "Search results for '{0}':".format(options.search_query)
-			videx.sync()
-													
-			for video in videx.search(options.search_query,
-										options.threshold,
-										options.limit):
+			with timings.phase("sync"):
+				videx.sync()
+			
+			with timings.phase("search"):
+				results = list(videx.search(options.search_query,
+											options.threshold,
+											options.limit))
+			
+			for video in results:
 				if video.has_media:
 					print " - {0} * {1}".format(video.id, video.title)
 				else:
@@ -266,32 +583,84 @@ if __name__ == '__main__':
 
 			fmt = res_fmt_map[best_match[1]]
 		
-		videx.sync()
+		# Downloads left over from an interrupted batch are resumed
+		# along with the new ones.
+		queue = DownloadQueue(state_path(options.index_dir, "downloads"),
+								options.max_downloads,
+								config["download_retries"])
+		if len(queue):
+			print "Resuming {0} unfinished downloads ...".format(len(queue))
+		
+		# Media is downloaded to the part file and only moved into place
+		# once the download has succeeded, so an interrupted download is
+		# never mistaken for a complete one.
+		def enqueue(video):
+			
+			if videx.restore_media(video.id):
+				print "Restored {0} from the media store.".format(video.id)
+				return
+				
+			queue.add(video.id, video.format_command(options.cmd, 
+									format=fmt, media_file=video.part_file))
+		
+		if options.partial:
+			
+			with timings.phase("sync"):
+				videx.sync()
+			
+			for video in videx.partial_downloads():
+				print "Resuming partial download of {0} ...".format(video.id)
+				enqueue(video)
 		
 		if options.search_query or options.search_query == "":
 			
+			with timings.phase("sync"):
+				videx.sync()
+			
 			print "'Cliving' all those matching query '{0}' ...".format(
 													options.search_query)
-													
-			for video in videx.search(options.search_query,
-										options.sr_threshold,
-										options.sr_limit):
-				video.execute_command(options.cmd, format=fmt)
+			
+			with timings.phase("search"):
+				results = list(videx.search(options.search_query,
+											options.threshold,
+											options.limit))
+			for video in results:
+				enqueue(video)
 				
 		else:
 			
+			with timings.phase("sync"):
+				videx.sync(args[1:])
+			
 			for vid in args[1:]:
 				try:
-					videx[vid].execute_command(options.cmd, format=fmt)
+					enqueue(videx[vid])
 				except KeyError:
 					print "Error: {0} not in index!".format(vid)
+		
+		failed = 0
+		timings.start("downloads")
+		for vid, status in queue.run():
+			if status == 0:
+				print "Downloaded {0}".format(vid)
+				videx.complete_download(vid)
+			else:
+				print "Error: Download of {0} failed with exit status" \
+												" {1}!".format(vid, status)
+				failed += 1
+				
+		timings.stop("downloads")
+		
+		if failed:
+			print "{0} downloads failed.".format(failed)
 					
 	elif action == "play":
 		
 		if not options.cmd:
 			options.cmd = DEFAULT_CONFIG["cmd"]["play"]
 		
-		videx.sync()
+		with timings.phase("sync"):
+			videx.sync(args[1:])
 		
 		try:
 			try:
@@ -304,26 +673,75 @@ if __name__ == '__main__':
 			
 	elif action == "repair":
 		
-		client = login(options.username, options.password)
+		import gdata.service
 		
-		for vid in args[1:]:
+		vids = args[1:]
+		if options.all:
 			
-			print "Attempting to repair {0}".format(vid)
+			# sync() notes the entries it can't load as it goes.
+			with timings.phase("sync"):
+				videx.sync()
 			
-			try:
-				videx.add(client.GetVideoMeta(vid=vid))
-			except gdata.service.RequestError as exce:
-				print "Error: Unexpected response to request!" \
-													" {0}".format(exce)
-			except AttributeError:
-				print "Error: Can't fetch video data for {0}".format(
-											entry.id.text.split("/")[-1])
+			damaged = sorted(videx.damaged.iteritems())
+			for reason in ("missing", "corrupted", "incomplete"):
+				count = len([vid for vid, why in damaged if why == reason])
+				if count:
+					print "Found {0} entries with {1} meta files.".format(
+																count, reason)
+			
+			vids = vids + [vid for vid, why in damaged if vid not in vids]
+			if not vids:
+				print "Nothing to repair."
+				exit()
+		
+		client = connect()
+		
+		def fetch_meta(vid):
+			with timings.phase("meta fetch"):
+				return client.GetVideoMeta(vid=vid)
+		
+		# The meta is fetched concurrently, but written from this thread,
+		# all flushed to disk at once at the end.
+		repaired = failed = 0
+		with videx.batch():
+			for vid, meta, exce in imap_unordered(fetch_meta, vids,
+														options.threads):
+				
+				if exce is None:
+					with timings.phase("index add"):
+						videx.add(meta)
+					print "Repaired {0}".format(vid)
+					repaired += 1
+					continue
+				
+				failed += 1
+				if isinstance(exce, gdata.service.RequestError):
+					print "Error: Unexpected response to request for {0}!" \
+												" {1}".format(vid, exce)
+				elif isinstance(exce, AttributeError):
+					print "Error: Can't fetch video data for {0}".format(vid)
+				elif isinstance(exce, LoginError):
+					# As would the rest.
+					print "Error: Can't log in again! {0}".format(exce)
+					failed = len(vids) - repaired
+					break
+				else:
+					raise exce
+		
+		print "Repaired {0} of {1} entries.".format(repaired, len(vids)),
+		if failed:
+			print "{0} failed.".format(failed)
+		else:
+			print
+		
+		notify_server(vids)
 	
 	elif action == "clean":
 
-		videx.sync()
+		with timings.phase("sync"):
+			videx.sync()
 		
-		ex_rule = ExclusionRule(options.rule)
+		ex_rule = load_rule(options.rule)
 		print "Deletion rule: {0}".format(ex_rule.expression)
 		
 		confirmed = options.force
@@ -338,12 +756,45 @@ if __name__ == '__main__':
 				pass
 		
 		print "Deleting ..."
-		for vid, entry in videx:
-			if ex_rule.evaluate(entry):
-				entry.delete()
+		with timings.phase("rule eval"):
+			deleted = videx.matching(ex_rule)
+		with timings.phase("disk writes"):
+			for vid in deleted:
+				videx.delete(vid)
+		print "Deleted {0} entries.".format(len(deleted))
+	
+	elif action == "serve":
+		
+		import socket
+		from index_server import IndexServer
+		from index_watcher import watch
+		
+		try:
+			server = IndexServer(socket_path, videx)
+		except socket.error as exce:
+			print "Error: Can't serve the index at '{0}'! {1}".format(
+														socket_path, exce)
+			exit()
+		
+		# Anyone who connects in the meantime waits for this.
+		with timings.phase("sync"):
+			videx.sync()
+		
+		if config["watch_interval"] > 0:
+			server.watcher = watch(videx, config["watch_interval"])
+		
+		print "Serving the index at '{0}'; Ctrl+C to stop ...".format(
+															socket_path)
+		try:
+			server.serve_forever()
+		except KeyboardInterrupt:
+			pass
+		finally:
+			server.close()
 		
 	else:
 
 		option_parser.print_usage()
-		
-		
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,160 @@
+
+# Copyright (C) 2011 by Oliver Ainsworth
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import time
+import threading
+import contextlib
+
+class Timings(object):
+	
+	def __init__(self):
+		"""
+			Accumulates how much wall time is spent in each named phase
+			of a run, and how many times each was entered. Phases may be
+			timed from several threads at once; their times are summed.
+		"""
+		
+		self.phases = {}
+		self.order = []
+		self.started = {}
+		self.lock = threading.Lock()
+	
+	def record(self, name, seconds):
+		
+		with self.lock:
+			if name not in self.phases:
+				self.phases[name] = [0.0, 0]
+				self.order.append(name)
+			self.phases[name][0] += seconds
+			self.phases[name][1] += 1
+	
+	@contextlib.contextmanager
+	def phase(self, name):
+		
+		start = time.time()
+		try:
+			yield
+		finally:
+			self.record(name, time.time() - start)
+	
+	def start(self, name):
+		"""
+			Starts timing `name` until stop() is called. For phases which
+			don't fit neatly in a with statement.
+		"""
+		
+		self.started[name] = time.time()
+	
+	def stop(self, name):
+		
+		start = self.started.pop(name, None)
+		if start is not None:
+			self.record(name, time.time() - start)
+	
+	def report(self):
+		"""
+			Returns a list of lines describing the time spent in each
+			phase, in the order they were first entered.
+		"""
+		
+		lines = ["{0:<40} {1:>10} {2:>8}".format("Phase", "Seconds", "Count")]
+		for name in self.order:
+			seconds, count = self.phases[name]
+			lines.append("{0:<40} {1:>10.3f} {2:>8}".format(
+												name[:40], seconds, count))
+		
+		return lines
+
+class RequestStats(object):
+	
+	# The upper bounds, in seconds, of the buckets of the latency
+	# histogram; the last catches everything slower.
+	buckets = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, float("inf"))
+	
+	def __init__(self):
+		"""
+			Counts the requests made by a YouTubeClient, by method, along
+			with how many failed, how many were retries, a histogram of
+			their latencies and how long was spent waiting on the rate
+			limiter. Thread-safe.
+		"""
+		
+		self.requests = {}
+		self.histogram = [0] * len(self.__class__.buckets)
+		self.throttled = 0.0
+		self.cache = {"hits": 0, "revalidated": 0, "misses": 0}
+		self.lock = threading.Lock()
+	
+	def record(self, method, seconds, failed=False, retry=False):
+		
+		with self.lock:
+			counts = self.requests.setdefault(method, [0, 0, 0, 0.0])
+			counts[0] += 1
+			counts[1] += int(failed)
+			counts[2] += int(retry)
+			counts[3] += seconds
+			
+			for i, bound in enumerate(self.__class__.buckets):
+				if seconds <= bound:
+					self.histogram[i] += 1
+					break
+	
+	def record_wait(self, seconds):
+		
+		with self.lock:
+			self.throttled += seconds
+	
+	def record_cache(self, outcome):
+		"""
+			Records a request which was a response cache "hits",
+			"revalidated" or "misses".
+		"""
+		
+		with self.lock:
+			self.cache[outcome] += 1
+	
+	def report(self):
+		"""
+			Returns a list of lines describing the requests recorded.
+		"""
+		
+		lines = ["{0:<30} {1:>8} {2:>8} {3:>8} {4:>10}".format(
+						"Request", "Count", "Failed", "Retries", "Mean (s)")]
+		for method in sorted(self.requests):
+			count, failed, retries, seconds = self.requests[method]
+			lines.append("{0:<30} {1:>8} {2:>8} {3:>8} {4:>10.3f}".format(
+							method, count, failed, retries, seconds / count))
+		
+		lines.append("Latency:")
+		lower = 0
+		for bound, count in zip(self.__class__.buckets, self.histogram):
+			lines.append("  {0:>6}s - {1:<6} {2:>8}".format(
+						lower, "" if bound == float("inf") else "{0}s".format(bound),
+						count))
+			lower = bound
+			
+		lines.append("Time spent throttled: {0:.3f}s".format(self.throttled))
+		
+		if any(self.cache.itervalues()):
+			lines.append("Response cache: {hits} hits, {revalidated}"
+							" revalidated, {misses} misses".format(**self.cache))
+		
+		return lines
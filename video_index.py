@@ -20,10 +20,129 @@
 # THE SOFTWARE.
 
 import os
+import stat
 import json
 import subprocess
+import heapq
+import hashlib
+try:
+	import cPickle as pickle
+except ImportError:
+	import pickle
 from time import sleep
 from shutil import rmtree
+from contextlib import contextmanager
+
+from search_index import SearchIndex
+
+# The hidden directory, within the index directory, housing the state
+# files of the index, e.g. its cache. See state_path().
+STATE_DIR_NAME = ".pysubbox"
+
+def state_path(directory, name):
+	"""
+		Returns the path of the state file `name`, e.g. "cache", of the
+		index at `directory`.
+		
+		State files are kept in a directory of their own so that writing
+		them doesn't change the mtime of the index directory, which is
+		how sync() tells whether entries have been added or removed.
+		A state file left at the root of the index by older versions,
+		as "." + `name`, is moved into it.
+	"""
+	
+	state_dir = os.path.join(directory, STATE_DIR_NAME)
+	if os.path.isdir(directory) and not os.path.isdir(state_dir):
+		os.mkdir(state_dir)
+	
+	path = os.path.join(state_dir, name)
+	legacy_path = os.path.join(directory, "." + name)
+	if os.path.isfile(legacy_path) and not os.path.exists(path):
+		os.rename(legacy_path, path)
+	
+	return path
+
+def load_json(path, type_, description):
+	"""
+		Returns the JSON stored at `path` as a `type_`, e.g. dict. If
+		`path` doesn't exist an empty `type_` is returned, as it is if
+		it can't be parsed, after warning that the `description`, e.g.
+		"Feed marks file", is corrupt.
+	"""
+	
+	try:
+		with open(path, "r") as json_file:
+			return type_(json.load(json_file))
+	except IOError:
+		pass
+	except (ValueError, TypeError):
+		print "Warning: {0} is corrupt, ignoring it ...".format(description)
+		
+	return type_()
+
+def replace_file(path, write, mode=None):
+	"""
+		Replaces the file at `path` with one written by `write`, which
+		is called with a file object. It's written to a temporary file
+		first and then renamed over `path`, so an interrupted write
+		never leaves a half-written file. If `mode` is given, the
+		file is created with those permissions rather than made so
+		afterwards.
+	"""
+	
+	tmp_path = path + ".tmp"
+	if mode is None:
+		tmp_file = open(tmp_path, "wb")
+	else:
+		if os.path.exists(tmp_path):
+			os.remove(tmp_path)
+		tmp_file = os.fdopen(os.open(tmp_path, 
+							os.O_WRONLY | os.O_CREAT | os.O_EXCL, mode), "wb")
+		
+	with tmp_file:
+		write(tmp_file)
+	os.rename(tmp_path, path)
+
+def utf8(value):
+	"""
+		Returns `value` as a str. Unicode, e.g. as meta read back from
+		JSON is, is encoded as UTF-8, the same as the meta YouTube
+		gives us.
+	"""
+	
+	if isinstance(value, unicode):
+		return value.encode("utf-8")
+	return str(value)
+
+def file_sha1(path):
+	"""
+		Returns the hex digest of the SHA-1 checksum of the file at
+		`path`.
+	"""
+	
+	sha1 = hashlib.sha1()
+	with open(path, "rb") as file_:
+		for chunk in iter(lambda: file_.read(1024 * 1024), ""):
+			sha1.update(chunk)
+			
+	return sha1.hexdigest()
+
+def flush_to_disk(paths):
+	"""
+		Makes sure the contents of the files at `paths` have reached the
+		disk by fsync()ing each. Directories can be given as well, to
+		make sure files created, removed or renamed within them are.
+		
+		Unlike a sync(2), this only waits for the files given, not
+		everything else being written, e.g. media being downloaded.
+	"""
+	
+	for path in paths:
+		fd = os.open(path, os.O_RDONLY)
+		try:
+			os.fsync(fd)
+		finally:
+			os.close(fd)
 
 class VideoIndexEntry(object):
 	
@@ -38,35 +157,98 @@ class VideoIndexEntry(object):
 				"uri": "uri",
 				"id": "id",
 				"date_published": "date_published",
+				"media_size": "expected_media_size",
+				"media_sha1": "media_sha1",
 				}
 	
-	def __init__(self, directory, meta):
+	# Meta which is recorded locally, rather than coming from YouTube.
+	local_keys = ("media_size", "media_sha1")
+	
+	# Meta which comes from YouTube, as returned by GetVideoMeta(); a
+	# meta file without all of it is incomplete.
+	required_keys = ("id", "uri", "title", "description", "category", 
+						"tags", "date_published")
+	
+	# Indexes can hold tens of thousands of entries, so they're kept
+	# lean: no per-instance __dict__, categories and tags are interned
+	# so each distinct one is only stored once, and file paths are
+	# derived from the directory when needed.
+	__slots__ = (
+				"directory",
+				"date_published",
+				"title",
+				"_description",
+				"category",
+				"tags",
+				"uri",
+				"id",
+				"expected_media_size",
+				"media_sha1",
+				"_media",
+				"_part",
+				)
+	
+	def __init__(self, directory, meta, media=None, part=None):
+		"""
+			If `meta` has no "description" key, the description is only
+			loaded from the meta file the first time it's needed.
+			
+			`media` is the state of the media file, as returned by
+			media_state(), and `part` whether a partially downloaded
+			media file exists, if they're already known. Otherwise
+			they're looked up the first time they're needed.
+		"""
 		
 		self.directory = str(directory)
-		self.media_file = os.path.join(self.directory, "media")
-		self.meta_file = os.path.join(self.directory, "meta")
 		
 		# Changing anyone of these attributes does NOT change the meta
 		# JSON file; must call write_meta_file().
 		self.date_published = float(meta.get("date_published", 0.0))
-		self.title = str(meta.get("title", ""))
-		self.description = str(meta.get("description", ""))
-		self.category = str(meta.get("category", ""))
-		self.tags = list(meta.get("tags", []))
-		self.uri = str(meta["uri"])
-		self.id = str(meta["id"])
+		self.title = utf8(meta.get("title", ""))
+		self.category = intern(utf8(meta.get("category", "")))
+		self.tags = tuple([intern(utf8(tag)) for tag in meta.get("tags", [])])
+		self.uri = utf8(meta["uri"])
+		self.id = intern(utf8(meta["id"]))
+		
+		# Recorded once the media file has been downloaded, so a
+		# truncated media file can be told apart from a complete one.
+		self.expected_media_size = meta.get("media_size")
+		self.media_sha1 = meta.get("media_sha1")
+		
+		if "description" in meta:
+			self._description = utf8(meta["description"])
+		else:
+			self._description = None
+			
+		self._media = media
+		self._part = part
 	
-	def execute_command(self, cmd, **kwargs):
+	def format_command(self, cmd, **kwargs):
 		"""
-			Executes `cmd` as a child process. Uses Python 2.6/PEP 3101
-			string formatting, passing all attributes of `self` and 
-			`kwargs` as arguments to the str.format() call.
+			Returns `cmd` formatted using Python 2.6/PEP 3101 string
+			formatting, passing the entry's meta, `directory`, 
+			`media_file` and `meta_file` along with `kwargs` as arguments
+			to the str.format() call.
 			
-			If there are any intersections between `self.__dict__` and
-			`kwargs`, `kwargs`'s value take presedence.
+			If there are any intersections between those and `kwargs`,
+			`kwargs`'s value take presedence.
 		"""
-		subprocess.Popen(str(cmd).format(
-							**dict(self.__dict__, **kwargs)), shell=True)
+		
+		format_args = dict(self.meta, 
+							directory=self.directory,
+							media_file=self.media_file,
+							meta_file=self.meta_file)
+		format_args.update(kwargs)
+		
+		return str(cmd).format(**format_args)
+	
+	def execute_command(self, cmd, **kwargs):
+		"""
+			Executes `cmd`, as formatted by format_command(), as a
+			child process. Doesn't wait for it to finish.
+		"""
+		
+		subprocess.Popen(self.format_command(cmd, **kwargs), shell=True)
 	
 	def delete(self):
 		"""
@@ -76,9 +258,31 @@ class VideoIndexEntry(object):
 		rmtree(self.directory)
 	
 	def write_meta_file(self):
+		"""
+			Writes the meta file via a temporary file which is fsync'd
+			and then renamed over it, so a crash never leaves a half
+			written meta file behind. The entry directory is fsync'd
+			afterwards, so the rename isn't lost either.
+		"""
 		
-		with open(self.meta_file, "w") as meta_file:
+		os.rename(self.write_meta_tmp_file(), self.meta_file)
+		flush_to_disk([self.directory])
+	
+	def write_meta_tmp_file(self, fsync=True):
+		"""
+			Writes the meta to a temporary file alongside the meta file,
+			returning its path. It's up to the caller to rename it over
+			the meta file.
+		"""
+		
+		tmp_file = self.meta_file + ".tmp"
+		with open(tmp_file, "w") as meta_file:
 			json.dump(self.meta, meta_file, indent=4)
+			if fsync:
+				meta_file.flush()
+				os.fsync(meta_file.fileno())
+				
+		return tmp_file
 						
 	def _get_meta_dict(self):
 		
@@ -86,49 +290,155 @@ class VideoIndexEntry(object):
 		
 		for key, attr_name in self.__class__.keys_map.iteritems():
 			try:
-				meta_dict[key] = self.__getattribute__(attr_name)
+				meta_dict[key] = getattr(self, attr_name)
 			except AttributeError:
 				raise AttributeError(
 					"can't build meta dict; '{0}' attribute missing".format(attr_name))
 					
 		return meta_dict
 	
-	def _has_media(self):
+	def _get_media_file(self):
+		return os.path.join(self.directory, "media")
+	
+	def _get_part_file(self):
+		return os.path.join(self.directory, "media.part")
+	
+	def _get_meta_file(self):
+		return os.path.join(self.directory, "meta")
+	
+	def _load_description(self):
+		"""
+			Returns the description stored in the meta file.
+		"""
 		
-		for path in os.listdir(self.directory):
-			
-			if (path == "media" and
-					os.path.isfile(os.path.join(self.directory, path))):
-				return True
+		try:
+			with open(self.meta_file, "r") as meta_file:
+				return utf8(json.load(meta_file).get("description", ""))
+		except (IOError, ValueError):
+			return ""
+	
+	def _get_description(self):
+		
+		if self._description is None:
+			self._description = self._load_description()
 				
-		return False
+		return self._description
+	
+	def _set_description(self, description):
+		self._description = utf8(description)
+	
+	@classmethod
+	def media_state(cls, media_file):
+		"""
+			Returns a (size, mtime) tuple for the file `media_file`, or
+			False if there is no such file.
+		"""
+		
+		try:
+			media_stat = os.stat(media_file)
+		except OSError:
+			return False
+		
+		if not stat.S_ISREG(media_stat.st_mode):
+			return False
+			
+		return (media_stat.st_size, media_stat.st_mtime)
+	
+	def refresh_media(self):
+		"""
+			Looks up the state of the media file, and whether there's a
+			partially downloaded one, again, e.g. after it's finished
+			downloading. Returns the new state, as for media_state().
+		"""
+		
+		self._media = self.__class__.media_state(self.media_file)
+		self._part = os.path.exists(self.part_file)
+		return self._media
+	
+	def _get_media(self):
+		
+		if self._media is None or self._part is None:
+			self.refresh_media()
 			
+		return self._media
+	
+	def _is_partial(self):
+		
+		media = self._get_media()
+		if self._part:
+			return True
+		
+		return bool(media and self.expected_media_size is not None and
+						media[0] != self.expected_media_size)
+	
+	def _has_media(self):
+		return bool(self._get_media())
+	
+	def _get_media_size(self):
+		
+		if self._get_media():
+			return self._media[0]
+		return None
+	
+	def _get_media_mtime(self):
+		
+		if self._get_media():
+			return self._media[1]
+		return None
+			
+	media_file = property(_get_media_file)
+	part_file = property(_get_part_file)
+	meta_file = property(_get_meta_file)
+	description = property(_get_description, _set_description)
 	has_media = property(_has_media)
+	partial = property(_is_partial)
+	media_size = property(_get_media_size)
+	media_mtime = property(_get_media_mtime)
 	meta = property(_get_meta_dict)
 	
 class VideoIndex(object):
 	
-	# TODO: Implement some kind of caching for the video index. Often
-	# the index will remain unchanged between each invocation, yet it
-	# still has to be rebuilt. This is suboptimal. DO SOME PROFILING
-	# to see wether it can be optmised by loading from disk, instead of
-	# doing a rebuild.
+	# The index is cached in a single pickle file, one of the state
+	# files of the index; see state_path(). It maps each entry directory to the mtime and size
+	# of its meta file, along with the parsed meta dictionary, so that
+	# sync() only has to read and parse those meta files which have
+	# actually changed since the last time it was called. The state of
+	# each entry's media file is cached likewise. The search
+	# index is stored alongside so it needn't be rebuilt either.
+	cache_name = "cache"
+	cache_version = 6
 	
-	def __init__(self, directory):
+	def __init__(self, directory, media_store=None):
 		"""
 			Represents a local video index.
 			
 				`directory` - the path to the directory which should be
 							indexed. If does not exist, will attempt
 							to create.
+							
+				`media_store` - a MediaStore, if downloaded media should
+							be deduplicated.
 		"""
 		
 		self.videos = {}
+		self.search_index = SearchIndex()
+		self.media_store = media_store
+		
+		# Maps the IDs of entries which sync() couldn't load to why:
+		# "missing", "corrupted" or "incomplete" meta files.
+		self.damaged = {}
+		
+		# While in a batch(), the (temporary file, meta file) pairs of
+		# the meta files written so far.
+		self._batch = None
 		
 		self.directory = str(directory)
 		if not os.path.isdir(self.directory):
 			print "'{0}' does not exist, creating it ...".format(self.directory)
 			os.mkdir(self.directory)
+			
+		self.cache_file = state_path(self.directory, 
+										self.__class__.cache_name)
 	
 	def __getitem__(self, name):
 		return self.videos[name]
@@ -142,30 +452,147 @@ class VideoIndex(object):
 	def __contains__(self, obj):
 		return obj in self.videos
 	
-	def add(self, meta):
+	def add(self, meta, rule=None):
 		"""		
 			Creates a VideoIndexEntry from `meta` and a directory to
 			house it if one doesn't already exist. If it does, the meta
-			file will be overwritten, and the media file, if it exists,
-			deleted.
+			file will be overwritten, unless it's identical to `meta`
+			in which case nothing is written at all.
 			
 			The entry is added to the index. If the entry ID is already
-			in the index, it's overidden.
+			in the index, it's overidden. Returns the entry.
+			
+			If `rule` is set to an ExclusionRule which the entry matches,
+			the entry isn't added and None is returned. Nothing is
+			written to disk, but if the entry already existed it's
+			deleted.
 		"""
 		
 		dir_name = os.path.join(self.directory, meta["id"])
+		entry = VideoIndexEntry(dir_name, meta)
+		
+		if rule is not None and rule.evaluate(entry):
+			if os.path.exists(dir_name) and entry.id not in self.videos:
+				self.sync([entry.id])
+			if entry.id in self.videos:
+				self.delete(entry.id)
+			elif os.path.exists(dir_name):
+				entry.delete()
+			return None
+		
 		if not os.path.exists(dir_name):
 			os.mkdir(dir_name)
-
-		entry = VideoIndexEntry(dir_name, meta)
-		entry.write_meta_file()
+		elif meta["id"] not in self.videos:
+			self.sync([meta["id"]])
+		
+		existing = self.videos.get(entry.id)
+		if existing is not None:
+			entry = VideoIndexEntry(dir_name, 
+									self._merge_local_meta(existing, meta))
+			if existing.meta == entry.meta:
+				return existing
+		
+		if self._batch is None:
+			entry.write_meta_file()
+		else:
+			self._batch.append((entry.write_meta_tmp_file(fsync=False), 
+									entry.meta_file))
+		
+		self.videos[entry.id] = entry
+		self.search_index.add(entry.id, entry)
+		
+		return entry
+	
+	@contextmanager
+	def batch(self):
+		"""
+			A context manager grouping many add()s into one batch. The
+			meta files written within it are only flushed to disk, and
+			moved into place, when it exits. By then most of them have
+			been written back already, so it's much cheaper than
+			flushing each as it's written. Until then the old meta
+			files are left untouched.
+			
+			Whatever was added is committed even if the block raises.
+			Nested batches are part of the outermost one.
+		"""
+		
+		if self._batch is not None:
+			yield self
+			return
+		
+		self._batch = []
+		try:
+			yield self
+		finally:
+			batch, self._batch = self._batch, None
+			self._commit_batch(batch)
+	
+	def _commit_batch(self, batch):
+		
+		if not batch:
+			return
+		
+		# The meta files have had the whole batch to be written back, so
+		# most of them won't keep fsync() waiting. The directories they're
+		# renamed within, and the index directory the new ones were made
+		# in, are flushed last so the renames themselves are durable.
+		flush_to_disk([tmp_file for tmp_file, meta_file in batch])
+		for tmp_file, meta_file in batch:
+			os.rename(tmp_file, meta_file)
+		
+		flush_to_disk(set([os.path.dirname(meta_file) 
+							for tmp_file, meta_file in batch]))
+		flush_to_disk([self.directory])
+	
+	def _merge_local_meta(self, existing, meta):
+		"""
+			Returns a copy of `meta` with the locally recorded meta of
+			the `existing` entry, e.g. the media checksum, carried over,
+			unless `meta` has its own.
+		"""
+		
+		meta = dict(meta)
+		for key in VideoIndexEntry.local_keys:
+			if meta.get(key) is None:
+				meta[key] = existing.meta[key]
+				
+		return meta
+	
+	def delete(self, vid):
+		"""
+			Removes the entry with the ID `vid` from the index and
+			deletes its directory, along with anything in it.
+		"""
+		
+		self._delete_files(self.videos.pop(vid))
+		self.search_index.remove(vid)
+	
+	def _delete_files(self, entry):
+		"""
+			Deletes the directory of `entry`, releasing its media from
+			the media store.
+		"""
+		
+		if os.path.exists(entry.directory):
+			entry.delete()
 		
-		self.videos[entry.id] = entry			
+		if self.media_store is not None and entry.media_sha1:
+			self.media_store.release(entry.media_sha1)
 	
-	# TODO: allow sync() to take an argument which specifies a specific
-	# directory to be syncronised. Saves having to do a complete resync
-	# everytime one video is added.
-	def sync(self):
+	def sync(self, vids=None):
+		"""
+			Populates the index from the entry directories, using the
+			index cache to avoid re-reading meta files which haven't
+			changed. The cache is rewritten afterwards if anything
+			was found to have changed.
+			
+				`vids` - an iterable of video IDs. If set, only the
+						entries for those IDs are synchronised and the
+						cache is bypassed entirely; entries whose
+						directory no longer exists are dropped from the
+						index.
+		"""
 		
 		# Profiles of sync appear to show some low-level caching going on
 		# which is causing the performance of posix.stat and file.read
@@ -180,25 +607,303 @@ class VideoIndex(object):
 		# ... and from one completed in 2.087:
 		# 740    0.099    0.000    0.099    0.000 {method 'read' of 'file' objects}
 		# 1484    0.064    0.000    0.064    0.000 {posix.stat}
+		
+		# With the cache, an unchanged index costs two stats per entry,
+		# of its directory, to validate the cached media state, and of
+		# its meta file, and no reads besides the cache itself.
+		# The directory listing is only redone if the mtime of the index
+		# directory has changed, i.e. an entry was added or removed.
+		
+		if vids is not None:
+			for vid in vids:
+				self._sync_entry(str(vid))
+			return
 
 		print "Syncronising video index ..."
 		
-		for vid in os.listdir(self.directory):
+		# Damaged entries are never cached, so they're all found again.
+		self.damaged = {}
+		
+		cache = self._load_cache()
+		changed = False
+		
+		# Entries in the cached search index are still valid as long as
+		# their cache entry is; anything resynced is re-added to it by
+		# _sync_entry() and anything that's gone is removed below.
+		self.search_index = SearchIndex(cache["search"])
+		
+		dir_mtime = os.stat(self.directory).st_mtime
+		if dir_mtime == cache["dir_mtime"]:
+			listing = cache["listing"]
+		else:
+			listing = [vid for vid in os.listdir(self.directory)
+						if not vid.startswith(".") and 
+							os.path.isdir(os.path.join(self.directory, vid))]
+			# Even if the listing is the same, the cache is rewritten so
+			# it has the new mtime, else it'd be listed every time.
+			changed = True
+		
+		entries = {}
+		for vid in listing:
+			
+			cached = cache["entries"].get(vid)
+			synced = self._sync_entry(vid, cached)
+			if synced:
+				entries[vid] = synced
+				if synced is not cached:
+					changed = True
+		
+		for vid in cache["entries"]:
+			if vid not in entries:
+				self.search_index.remove(vid)
+				changed = True
+		
+		# Entries loaded by an earlier sync() which have since gone, or
+		# can no longer be loaded, are dropped.
+		for vid in self.videos.keys():
+			if vid not in entries:
+				del self.videos[vid]
+				self.search_index.remove(vid)
+		
+		if changed or len(entries) != len(cache["entries"]):
+			self._write_cache({
+						"version": self.__class__.cache_version,
+						"dir_mtime": dir_mtime,
+						"listing": listing,
+						"entries": entries,
+						"search": self.search_index.state,
+						})
+		
+		partial = self.partial_downloads()
+		if partial:
+			print "Warning: {0} videos are only partially downloaded;" \
+				" 'download --partial' will resume them.".format(len(partial))
+	
+	def _sync_entry(self, vid, cached=None):
+		"""
+			Synchronises the single entry directory named `vid`.
+			
+			`cached` may be the entry's (meta key, meta, directory mtime,
+			media state, part file exists) tuple from the index cache. If
+			the mtime and size of the meta file match the meta key, the
+			cached meta is used rather than reading the file. If the
+			directory's mtime matches, the cached media state is used
+			rather than looking for the media and part files; the mtime
+			of a directory changes whenever a file is created, removed
+			or renamed within it.
 			
+			Descriptions are by far the largest part of the meta, yet
+			only needed for building the search index, so they aren't
+			kept in the cache or the entry; the entry loads it from the
+			meta file if it's ever needed again.
+			
+			Returns the tuple to cache for the entry, which will be
+			`cached` itself if it was still valid, or None if the entry
+			couldn't be loaded.
+		"""
+		
+		directory = os.path.join(self.directory, vid)
+		meta_file = os.path.join(directory, "meta")
+		self.damaged.pop(vid, None)
+		
+		try:
+			dir_mtime = os.stat(directory).st_mtime
+			meta_stat = os.stat(meta_file)
+		except OSError:
+			self.videos.pop(vid, None)
+			self.search_index.remove(vid)
+			if os.path.isdir(directory):
+				print "Error: Missing meta file for {0}".format(vid)
+				self.damaged[vid] = "missing"
+			return None
+		
+		key = (meta_stat.st_mtime, meta_stat.st_size)
+		if cached and cached[0] == key:
+			meta = cached[1]
+			entry = VideoIndexEntry(directory, meta)
+			if entry.id not in self.search_index:
+				self.search_index.add(entry.id, entry)
+		else:
 			try:
-				if os.path.isdir(os.path.join(self.directory, vid)):
-					if os.path.isfile(os.path.join(self.directory, vid, "meta")):
-						
-						with open(os.path.join(self.directory, vid, "meta"), "r") as file_:
-							entry = VideoIndexEntry(
-										os.path.join(self.directory, vid),
-												json.loads(file_.read()))
-							self.videos[entry.id] = entry
-					else:
-						print "Error: Missing meta file for {0}".format(vid)
-							
+				with open(meta_file, "r") as file_:
+					meta = json.loads(file_.read())
 			except ValueError:
+				meta = None
+			
+			if not isinstance(meta, dict):
 				print "Error: Corrupted entry for {0}".format(vid)
+				self.damaged[vid] = "corrupted"
+			elif [name for name in VideoIndexEntry.required_keys 
+					if name not in meta]:
+				print "Error: Incomplete meta file for {0}".format(vid)
+				self.damaged[vid] = "incomplete"
+			
+			if vid in self.damaged:
+				self.videos.pop(vid, None)
+				self.search_index.remove(vid)
+				return None
+			
+			entry = VideoIndexEntry(directory, meta)
+			self.search_index.add(entry.id, entry)
+			
+			meta = dict(meta)
+			meta.pop("description", None)
+		
+		if cached and cached[2] == dir_mtime:
+			media, part = cached[3:5]
+		else:
+			media = VideoIndexEntry.media_state(entry.media_file)
+			part = os.path.exists(entry.part_file)
+		
+		entry = VideoIndexEntry(directory, meta, media, part)
+		self.videos[entry.id] = entry
+		
+		synced = (key, meta, dir_mtime, media, part)
+		if cached and cached == synced:
+			return cached
+		
+		return synced
+	
+	def matching(self, rule):
+		"""
+			Returns a list of the IDs of the entries which match the
+			ExclusionRule `rule`.
+		"""
+		
+		return [entry.id for entry in rule.filter(self.videos.itervalues())]
+	
+	def clean(self, rule):
+		"""
+			Deletes every entry which matches the ExclusionRule `rule`.
+			Returns a list of the IDs of those deleted.
+		"""
+		
+		deleted = self.matching(rule)
+		for vid in deleted:
+			self.delete(vid)
+			
+		return deleted
+	
+	def partial_downloads(self):
+		"""
+			Returns a list of the entries whose media has only been
+			partially downloaded.
+		"""
+		
+		return [entry for entry in self.videos.itervalues() if entry.partial]
+	
+	def complete_download(self, vid):
+		"""
+			To be called once the media of the entry `vid` has been
+			downloaded to its part file. Renames the part file to the
+			media file and records its size and SHA-1 checksum in the
+			meta, so it can later be told whether it's complete.
+		"""
+		
+		if vid not in self.videos:
+			self.sync([vid])
+		entry = self.videos[vid]
+		
+		if os.path.exists(entry.part_file):
+			os.rename(entry.part_file, entry.media_file)
+		
+		media = entry.refresh_media()
+		if media:
+			entry.expected_media_size = media[0]
+			entry.media_sha1 = file_sha1(entry.media_file)
+			self._save_entry(entry)
+			
+			if self.media_store is not None:
+				self.media_store.add(entry.media_file, entry.media_sha1)
+				entry.refresh_media()
+	
+	def restore_media(self, vid):
+		"""
+			Restores the media of the entry `vid` from the media store,
+			if its checksum is known and the store has it, saving it
+			from being downloaded again. Returns whether it was restored.
+			
+			That's only the case for media which has been deleted while
+			the entry is still in the index; the checksum is forgotten,
+			and the media released from the store, along with the entry
+			itself.
+		"""
+		
+		entry = self.videos[vid]
+		if (self.media_store is None or not entry.media_sha1 or 
+				entry.has_media):
+			return False
+		
+		restored = self.media_store.restore(entry.media_sha1, entry.media_file)
+		entry.refresh_media()
+		
+		return restored
+	
+	def _save_entry(self, entry):
+		"""
+			Writes out the meta of `entry` after its attributes have been
+			changed.
+		"""
+		
+		entry.write_meta_file()
+	
+	def refresh_media(self, vids=None):
+		"""
+			Looks up the state of the media files of the entries with
+			the given IDs, or all of them if `vids` isn't set, again.
+			Useful once downloads have finished.
+		"""
+		
+		if vids is None:
+			vids = self.videos.keys()
+			
+		for vid in vids:
+			if vid in self.videos:
+				self.videos[vid].refresh_media()
+	
+	def _load_cache(self):
+		"""
+			Returns the contents of the index cache. If the cache is
+			missing, unreadable or from a different cache version, an
+			empty cache is returned instead.
+		"""
+		
+		empty = {
+				"version": self.__class__.cache_version,
+				"dir_mtime": None,
+				"listing": [],
+				"entries": {},
+				"search": None,
+				}
+		
+		try:
+			with open(self.cache_file, "rb") as cache_file:
+				cache = pickle.load(cache_file)
+		except IOError:
+			return empty
+		except Exception:
+			# Unpickling garbage can raise just about anything.
+			print "Warning: Index cache is corrupt, rebuilding it ..."
+			return empty
+			
+		if (not isinstance(cache, dict) or
+				cache.get("version") != self.__class__.cache_version):
+			return empty
+			
+		return cache
+	
+	def _write_cache(self, cache):
+		"""
+			Writes `cache` to the index cache file, by way of
+			replace_file() so an interrupted write never leaves a
+			half-written cache.
+		"""
+		
+		try:
+			replace_file(self.cache_file, lambda cache_file: 
+							pickle.dump(cache, cache_file, pickle.HIGHEST_PROTOCOL))
+		except (IOError, OSError) as exce:
+			print "Warning: Failed to write index cache! {0}".format(exce)
 	
 	def search(self, query, threshold=0.25, limit=None):
 		"""
@@ -220,29 +925,34 @@ class VideoIndex(object):
 		#		for acronyms, names, and ignore all non-nouns, for example.
 		#	- Apache Lucene via PyLucene.
 		
-		if limit == 0:
-			limit = None
+		# Only the posting lists of the query terms are visited. Videos
+		# which don't match any term have a weight of zero, so they only
+		# need considering when the threshold lets zero weights through,
+		# e.g. an empty query listing the entire index.
 		
-		results = []
-		qsplit = [chunk.lower().strip() for chunk in query.split(" ") if len(chunk) > 2]
+		return self._rank(self.search_index.weigh(query), threshold, limit)
+	
+	def _rank(self, weights, threshold, limit):
+		"""
+			Returns a generator of the entries which reach `threshold`
+			of the highest of `weights`, a dictionary mapping video IDs
+			to their weight, best first. See search().
+		"""
 		
-		for video in self.videos.itervalues():
-			
-			weight = 0
-			
-			weight += 0.1 * len(set(qsplit).intersection(set([tag.lower() for tag in video.tags])))
-			weight += 0.15 * len(set(qsplit).intersection(set([video.category.lower()])))
-			weight += 0.25 * len(set(qsplit).intersection(set([chunk.lower() for chunk in video.description.split(" ")])))
-			weight += 0.35 * len(set(qsplit).intersection(set([chunk.lower() for chunk in video.title.split(" ")])))
-			
-			results.append((weight, video))
+		if limit == 0:
+			limit = None
 		
-		results.sort(key=lambda result: result[0])
+		cutoff = max(weights.itervalues()) * threshold if weights else 0
+		if cutoff > 0:
+			results = [(weight, vid) for vid, weight in weights.iteritems()
+							if weight >= cutoff and vid in self.videos]
+		else:
+			results = [(weights.get(vid, 0), vid) for vid in self.videos]
 		
-		result_count = 0
-		for result in results[::-1]:
-			if result[0] >= (results[-1][0] * threshold):
-				if result_count < limit or limit is None:
-					yield result[1]
-					result_count += 1
+		if limit is None:
+			results.sort(reverse=True)
+		else:
+			results = heapq.nlargest(limit, results)
 		
+		for weight, vid in results:
+			yield self.videos[vid]
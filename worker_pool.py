@@ -0,0 +1,123 @@
+
+# Copyright (C) 2011 by Oliver Ainsworth
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import threading
+from Queue import Queue, Empty
+
+# Yielded by istream_unordered() as the value once an item's iterable
+# has been exhausted.
+FINISHED = object()
+
+def _run_pool(work, items, workers):
+	"""
+		Starts, at most, `workers` daemon threads which call `work` with
+		each of `items` in turn until there are none left.
+	"""
+	
+	tasks = Queue()
+	for item in items:
+		tasks.put(item)
+	
+	def run():
+		while True:
+			try:
+				item = tasks.get_nowait()
+			except Empty:
+				return
+			work(item)
+	
+	for i in xrange(max(1, min(int(workers), len(items)))):
+		thread = threading.Thread(target=run)
+		thread.daemon = True
+		thread.start()
+
+def _get(results):
+	
+	# Waiting without a timeout isn't interruptible by Ctrl+C under
+	# Python 2, hence the polling.
+	while True:
+		try:
+			return results.get(True, 1)
+		except Empty:
+			pass
+
+def imap_unordered(func, items, workers):
+	"""
+		Calls `func` once for each of `items` using a pool of, at most,
+		`workers` threads. Returns a generator which yields a tuple of
+		(item, result, exception) as each call completes, so the order
+		isn't necessarily that of `items`.
+		
+		If the call raised an exception, `result` will be None and 
+		`exception` the exception instance, otherwise `exception` will
+		be None. Exceptions are never raised in the calling thread.
+		That includes SystemExit and the like, so a call which exits
+		doesn't leave the caller waiting forever for its result.
+	"""
+	
+	items = list(items)
+	results = Queue()
+	
+	def work(item):
+		try:
+			results.put((item, func(item), None))
+		except BaseException as exce:
+			results.put((item, None, exce))
+	
+	_run_pool(work, items, workers)
+	
+	for i in xrange(len(items)):
+		yield _get(results)
+
+def istream_unordered(func, items, workers, buffer_size=64):
+	"""
+		Like imap_unordered(), except `func` returns an iterable and
+		a tuple of (item, value, None) is yielded for each value of it
+		as soon as it's produced. Once an item's iterable is exhausted,
+		(item, FINISHED, None) is yielded. If it raises an exception
+		instead, (item, None, exception) is yielded and that item is
+		done with.
+		
+		No more than `buffer_size` values are buffered at a time; the
+		threads wait for the caller to catch up beyond that.
+	"""
+	
+	items = list(items)
+	results = Queue(buffer_size)
+	
+	def work(item):
+		try:
+			for value in func(item):
+				results.put((item, value, None))
+			results.put((item, FINISHED, None))
+		except BaseException as exce:
+			results.put((item, None, exce))
+	
+	_run_pool(work, items, workers)
+	
+	finished = 0
+	while finished < len(items):
+		
+		result = _get(results)
+		if result[1] is FINISHED or result[2] is not None:
+			finished += 1
+			
+		yield result
@@ -20,25 +20,353 @@
 # THE SOFTWARE.
 
 import time
+import random
+import threading
+from email.utils import formatdate
 
+# time.strptime() imports this on first use, which isn't thread-safe; it
+# fails if feeds are first parsed by several threads at once.
+import _strptime
+
+from timings import RequestStats
+
+import gdata.service
 import gdata.youtube
 import gdata.youtube.service
 
+class RateLimiter(object):
+	
+	def __init__(self, rate, burst=None, min_rate=0.1):
+		"""
+			A thread-safe token bucket which allows, on average, `rate`
+			calls to acquire() per second, with bursts of up to `burst`
+			calls. Defaults to bursts of a second's worth of calls.
+			
+			The rate adapts to how the server responds: penalise() halves
+			it, down to `min_rate`, and reward() raises it again by a
+			tenth of the original rate at a time.
+		"""
+		
+		self.max_rate = self.rate = float(rate)
+		self.min_rate = min(float(min_rate), self.max_rate)
+		self.burst = float(burst or max(1, self.max_rate))
+		
+		self.tokens = self.burst
+		self.last_refill = time.time()
+		self.lock = threading.Lock()
+	
+	def _refill(self):
+		
+		now = time.time()
+		self.tokens = min(self.burst, 
+						self.tokens + (now - self.last_refill) * self.rate)
+		self.last_refill = now
+	
+	def acquire(self):
+		"""
+			Blocks until a token is available and takes it.
+		"""
+		
+		while True:
+			with self.lock:
+				self._refill()
+				if self.tokens >= 1:
+					self.tokens -= 1
+					return
+				wait = (1 - self.tokens) / self.rate
+				
+			time.sleep(wait)
+	
+	def penalise(self):
+		
+		with self.lock:
+			self._refill()
+			self.rate = max(self.min_rate, self.rate / 2)
+			self.tokens = 0
+	
+	def reward(self):
+		
+		with self.lock:
+			self._refill()
+			self.rate = min(self.max_rate, self.rate + self.max_rate / 10)
+
+def response_status(exce):
+	"""
+		Returns the HTTP status code of the response which caused the
+		gdata.service.RequestError `exce`, or None if it's not known.
+	"""
+	
+	# RequestErrors are raised with a dict of the status, reason and
+	# body of the response.
+	try:
+		return exce.args[0]["status"]
+	except (IndexError, KeyError, TypeError):
+		return None
+
+class CachedResponse(object):
+	
+	def __init__(self, body, headers=None):
+		"""
+			Stands in for the httplib.HTTPResponse of a successful
+			request, when its body is already known.
+		"""
+		
+		self.status = 200
+		self.reason = "OK"
+		self.body = body
+		self.headers = headers or {}
+	
+	def read(self):
+		return self.body
+	
+	def getheader(self, name, default=None):
+		return self.headers.get(name, default)
+
 class YouTubeClient(gdata.youtube.service.YouTubeService):
 	
+	# Responses with these status codes are taken as the server asking
+	# us to slow down; the request is retried after backing off.
+	retry_statuses = (403, 503)
+	max_retries = 3
+	
+	# The delay before the nth retry is somewhere between half and all
+	# of backoff * 2 ** n seconds, capped to max_backoff.
+	backoff = 1.0
+	max_backoff = 30.0
+	
+	def __init__(self, *args, **kwargs):
+		"""
+			As YouTubeService, plus the keyword arguments:
+			
+				`rate` - the maximum number of requests per second
+						the client will make.
+				
+				`stats` - a RequestStats to record requests in.
+				
+				`reauthenticate` - called with the client when a
+						request is refused as unauthorised, e.g. the
+						login session has expired, to log in again.
+						The request is then retried, once.
+				
+				`response_cache` - a ResponseCache to serve GET
+						requests from, where it can.
+		"""
+		
+		rate = kwargs.pop("rate", 5)
+		stats = kwargs.pop("stats", None)
+		self.reauthenticate = kwargs.pop("reauthenticate", None)
+		self.response_cache = kwargs.pop("response_cache", None)
+		gdata.youtube.service.YouTubeService.__init__(self, *args, **kwargs)
+		
+		self.rate_limiter = RateLimiter(rate)
+		self.stats = stats or RequestStats()
+		self.auth_lock = threading.Lock()
+	
 	@classmethod
-	def Login(cls, username, password):
+	def Login(cls, username, password, rate=5, stats=None):
 		"""
 			Convenience method that creates a new YouTubeService
 			instance and performs a log-in using the given credentials
 			via YouTubeService.ClientLogin().
+			
+			`rate` is the maximum number of requests per second the
+			client will make. Requests are recorded in `stats`, a
+			RequestStats, if given.
 		"""
 		
-		client = cls(username, password)
+		client = cls(username, password, rate=rate, stats=stats)
 		client.ClientLogin(username, password)
 		
 		return client
 	
+	def request(self, operation, url, data=None, headers=None, 
+															url_params=None):
+		"""
+			Makes a request, as YouTubeService.request(), once the rate
+			limiter allows it. Every request the client makes goes
+			through here.
+			
+			If there's a response cache, GET requests are served from it
+			while the cached response is fresh, and revalidated with the
+			server once it isn't. Requests which are already conditional
+			always go to the server, so the caller gets its answer.
+			
+			Responses to requests made while logged in are cached for
+			that user alone, as some, e.g. the subscription feed of
+			users/default, depend on who's asking.
+		"""
+		
+		cache = self.response_cache
+		if (cache is None or operation != "GET" or url_params or data or
+				not isinstance(url, basestring) or
+				"If-Modified-Since" in (headers or {}) or
+				"If-None-Match" in (headers or {})):
+			return self._Request(operation, url, data, headers, url_params)
+		
+		key = url
+		if self.GetClientLoginToken():
+			key = "{0} as {1}".format(url, self.email)
+		
+		cached = cache.lookup(key)
+		if cached is not None and cache.fresh(cached):
+			self.stats.record_cache("hits")
+			return CachedResponse(cached["body"])
+		
+		headers = dict(headers or {})
+		if cached is not None:
+			if cached["etag"]:
+				headers["If-None-Match"] = cached["etag"]
+			if cached["last_modified"]:
+				headers["If-Modified-Since"] = cached["last_modified"]
+		
+		response = self._Request(operation, url, data, headers, url_params)
+		
+		if response.status == 304 and cached is not None:
+			self.stats.record_cache("revalidated")
+			cache.store(key, cached["body"],
+						response.getheader("ETag") or cached["etag"],
+						response.getheader("Last-Modified") or 
+													cached["last_modified"])
+			return CachedResponse(cached["body"])
+		
+		if response.status != 200:
+			return response
+		
+		self.stats.record_cache("misses")
+		body = response.read()
+		cache.store(key, body, response.getheader("ETag"), 
+								response.getheader("Last-Modified"))
+		
+		return CachedResponse(body)
+	
+	def _Request(self, operation, url, data, headers, url_params):
+		
+		start = time.time()
+		self.rate_limiter.acquire()
+		self.stats.record_wait(time.time() - start)
+		
+		return gdata.youtube.service.YouTubeService.request(self, operation,
+										url, data, headers, url_params)
+	
+	def _ThrottledCall(self, func, *args, **kwargs):
+		"""
+			Calls `func`, retrying with exponential backoff and jitter if
+			it raises a RequestError with one of the `retry_statuses`.
+			The RequestError is re-raised once `max_retries` is
+			exhausted. The requests `func` makes are rate limited by
+			request().
+		"""
+		
+		attempt = 0
+		reauthenticated = False
+		while True:
+			
+			token = self.GetClientLoginToken()
+			
+			start = time.time()
+			try:
+				result = func(*args, **kwargs)
+			except gdata.service.RequestError as exce:
+				
+				# Not modified isn't a failure, but comes as one.
+				self.stats.record(func.__name__, time.time() - start, 
+									failed=response_status(exce) != 304,
+									retry=attempt > 0)
+				
+				if (response_status(exce) == 401 and not reauthenticated and
+						self.reauthenticate is not None):
+					self._Reauthenticate(token)
+					reauthenticated = True
+					continue
+				
+				if (response_status(exce) not in self.__class__.retry_statuses or
+						attempt >= self.__class__.max_retries):
+					raise
+				
+				self.rate_limiter.penalise()
+				
+				delay = min(self.__class__.max_backoff,
+							self.__class__.backoff * 2 ** attempt)
+				time.sleep(random.uniform(delay / 2, delay))
+				attempt += 1
+				
+			else:
+				self.stats.record(func.__name__, time.time() - start, 
+									retry=attempt > 0)
+				self.rate_limiter.reward()
+				return result
+	
+	def _Reauthenticate(self, failed_token):
+		"""
+			Logs in again via `reauthenticate`, unless another thread
+			already has since `failed_token` was refused.
+		"""
+		
+		with self.auth_lock:
+			if self.GetClientLoginToken() == failed_token:
+				self.reauthenticate(self)
+	
+	def GetYouTubeSubscriptionFeed(self, *args, **kwargs):
+		return self._ThrottledCall(gdata.youtube.service.YouTubeService.
+							GetYouTubeSubscriptionFeed, self, *args, **kwargs)
+	
+	def GetYouTubeVideoFeed(self, uri, modified_since=None):
+		"""
+			Fetches the video feed at `uri`.
+			
+			If `modified_since` is set to a time in seconds since the
+			epoch, the request is made conditional on the feed having
+			changed since then; None is returned if it hasn't.
+		"""
+		
+		# YouTubeService.GetYouTubeVideoFeed offers no way to pass
+		# headers, so this does what it does via Get() instead.
+		extra_headers = None
+		if modified_since:
+			extra_headers = {"If-Modified-Since": 
+								formatdate(modified_since, usegmt=True)}
+		
+		try:
+			return self._ThrottledCall(self.Get, uri, 
+						extra_headers=extra_headers,
+						converter=gdata.youtube.YouTubeVideoFeedFromString)
+		except gdata.service.RequestError as exce:
+			if modified_since and response_status(exce) == 304:
+				return None
+			raise
+	
+	def IterVideoFeed(self, uri, max_pages=None, modified_since=None):
+		"""
+			Returns a generator of the entries of the video feed at
+			`uri`, following the feed's 'next' links to fetch further
+			pages as they're needed. Stops after `max_pages` pages, if
+			set. Nothing is fetched until the first entry is asked for
+			and closing the generator early stops any further requests.
+			
+			`modified_since` is as for GetYouTubeVideoFeed(); it applies
+			to the first page only. Nothing is yielded if the feed hasn't
+			been modified.
+		"""
+		
+		feed = self.GetYouTubeVideoFeed(uri, modified_since=modified_since)
+		pages = 1
+		
+		while feed is not None:
+			
+			for entry in feed.entry:
+				yield entry
+			
+			next_link = feed.GetNextLink()
+			if next_link is None or (max_pages and pages >= max_pages):
+				return
+			
+			feed = self.GetYouTubeVideoFeed(next_link.href)
+			pages += 1
+	
+	def GetYouTubeVideoEntry(self, *args, **kwargs):
+		return self._ThrottledCall(gdata.youtube.service.YouTubeService.
+							GetYouTubeVideoEntry, self, *args, **kwargs)
+	
 	def GetVideoMeta(self, uri=None, vid=None, entry=None):
 		"""
 			Wraps the returned value of YoutubeService.GetYouTubeVideoEntry